@@ -0,0 +1,255 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import math
+import struct
+import time
+from collections import deque
+
+import numpy as np
+
+from emg import decodeEmgPacket
+from gforce import NotifDataType
+from orientation import QUAT_FORMAT, VECTOR_FORMAT
+
+
+# Estimate the host time of a device's samples from packet arrival times.
+#
+# The device clock is the sample counter: sample n was taken at
+# offset + n * period on the host clock, and its packet arrives some
+# non-negative BLE delay later. period is fitted by least squares over the
+# recent packets, offset follows the lower envelope of the arrival times so
+# that jitter only ever delays arrivals. drift is the relative rate error of
+# the device clock against its nominal rate.
+class ClockEstimator:
+    def __init__(self, nominalRate, history=500, envelope=5.0):
+        self.nominalRate = nominalRate
+        self.envelope = envelope
+        self.period = 1.0 / nominalRate
+        self.offset = None
+        self.drift = 0.0
+
+        self._points = deque(maxlen=history)
+
+    # lastIndex is the index of the last sample in the packet that arrived at arrival
+    def add(self, lastIndex, arrival):
+        self._points.append((lastIndex, arrival))
+
+    def fit(self):
+        if len(self._points) == 0:
+            return
+
+        p = np.asarray(self._points, dtype=np.float64)
+        n, t = p[:, 0], p[:, 1]
+
+        # Only trust the fitted rate once the points span a second of samples
+        if n[-1] - n[0] >= self.nominalRate:
+            keep = np.ones(len(n), dtype=bool)
+
+            # Refit on the earliest arrivals so the line follows the lower envelope
+            for _ in range(3):
+                nk, tk = n[keep], t[keep]
+                nMean = nk.mean()
+                period = np.sum((nk - nMean) * (tk - tk.mean())) / np.sum((nk - nMean) ** 2)
+                residual = t - period * n
+                keep = residual <= np.percentile(residual, 25)
+
+                if np.ptp(n[keep]) < self.nominalRate:
+                    break
+
+            if period > 0:
+                self.period = period
+                self.drift = self.nominalRate * period - 1.0
+
+        self.offset = np.percentile(t - self.period * n, self.envelope)
+
+    def toHostTime(self, indices):
+        return self.offset + self.period * np.asarray(indices, dtype=np.float64)
+
+
+class _Stream:
+    def __init__(self, device, dataType, channels, sampleRate, decoder, history):
+        self.device = device
+        self.dataType = dataType
+        self.channels = channels
+        self.decoder = decoder
+        self.clock = ClockEstimator(sampleRate, history)
+
+        self._chunks = []
+        # Sample index of the first buffered sample and the number of samples seen
+        self._firstIndex = 0
+        self._count = 0
+        self._values = np.empty((0, channels))
+        # Packets the decoder could not use, reported once
+        self.rejectedPackets = 0
+
+    def append(self, data, arrival):
+        samples = self.decoder(data)
+        if len(samples) == 0:
+            if self.rejectedPackets == 0:
+                print(
+                    "TimelineAligner: device {0} dropping type {1} packet of {2} bytes".format(
+                        self.device, hex(self.dataType), len(data)
+                    )
+                )
+            self.rejectedPackets += 1
+            return
+
+        self._chunks.append(samples)
+        self._count += len(samples)
+        self.clock.add(self._count - 1, arrival)
+
+    def collect(self):
+        if len(self._chunks) > 0:
+            self._values = np.concatenate([self._values] + self._chunks).astype(np.float64, copy=False)
+            self._chunks = []
+
+    def lastTime(self):
+        if self._count == 0:
+            return None
+        return float(self.clock.toHostTime(self._count - 1))
+
+    def firstTime(self):
+        return float(self.clock.toHostTime(self._firstIndex))
+
+    # Linear interpolation of all channels at the host times in grid, NaN outside the data
+    def sample(self, grid):
+        out = np.full((len(grid), self.channels), np.nan)
+
+        if len(self._values) < 2:
+            return out
+
+        pos = (grid - self.clock.offset) / self.clock.period - self._firstIndex
+        valid = (pos >= 0) & (pos <= len(self._values) - 1)
+        pos = pos[valid]
+
+        left = np.minimum(pos.astype(np.int64), len(self._values) - 2)
+        frac = (pos - left)[:, None]
+        out[valid] = self._values[left] * (1 - frac) + self._values[left + 1] * frac
+        return out
+
+    # Drop samples before host time t, keeping one for interpolation
+    def trim(self, t):
+        if self.clock.offset == None:
+            return
+
+        drop = math.floor((t - self.clock.offset) / self.clock.period) - self._firstIndex - 1
+        drop = min(max(drop, 0), len(self._values))
+
+        if drop > 0:
+            self._values = self._values[drop:]
+            self._firstIndex += drop
+
+
+def _structDecoder(fmt, channels):
+    def decode(data):
+        if len(data) != 1 + fmt.size:
+            return np.empty((0, channels))
+        return np.asarray([fmt.unpack_from(bytes(data), 1)], dtype=np.float64)
+
+    return decode
+
+
+# Align the streams of several devices onto one host timeline.
+#
+# Register the streams of every device, then feed each device's packets through
+# the callback returned by makeOnData. read() returns every complete block of
+# blockSize samples at rate Hz as (times, data) with data shaped
+# (samples, total channels), columns ordered as in self.columns. A block is
+# complete once every stream has samples past its end, or maxLatency seconds
+# after its end; samples a stream has not delivered by then are NaN.
+class TimelineAligner:
+    def __init__(self, rate, blockSize=50, maxLatency=0.2, history=500):
+        self.rate = rate
+        self.blockSize = blockSize
+        self.maxLatency = maxLatency
+        self.history = history
+
+        self.streams = []
+        # (device, dataType, channel) for each column of the output
+        self.columns = []
+
+        self._devices = {}
+        self._nextTime = None
+
+    def addStream(self, device, dataType, channels, sampleRate, decoder):
+        stream = _Stream(device, dataType, channels, sampleRate, decoder, self.history)
+        self.streams.append(stream)
+        self._devices.setdefault(device, {})[dataType] = stream
+        self.columns += [(device, dataType, i) for i in range(channels)]
+        return stream
+
+    def addEmgStream(self, device, channels, resolution, sampRate):
+        return self.addStream(
+            device,
+            NotifDataType.NTF_EMG_ADC_DATA,
+            channels,
+            sampRate,
+            lambda data: decodeEmgPacket(data, channels, resolution),
+        )
+
+    # NTF_QUAT_FLOAT_DATA or one of NTF_ACC_DATA, NTF_GYO_DATA, NTF_MAG_DATA.
+    # vectorFormat is the struct layout of the latter, see orientation.VECTOR_FORMAT.
+    def addImuStream(self, device, dataType, sampleRate, vectorFormat=VECTOR_FORMAT):
+        if dataType == NotifDataType.NTF_QUAT_FLOAT_DATA:
+            return self.addStream(device, dataType, 4, sampleRate, _structDecoder(QUAT_FORMAT, 4))
+
+        if isinstance(vectorFormat, str):
+            vectorFormat = struct.Struct(vectorFormat)
+        return self.addStream(device, dataType, 3, sampleRate, _structDecoder(vectorFormat, 3))
+
+    # Return an onData callback for device, optionally chained to onData
+    def makeOnData(self, device, profile=None, onData=None):
+        streams = self._devices[device]
+
+        def temp(data):
+            if len(data) > 0 and data[0] in streams:
+                if profile != None:
+                    arrival = profile.lastNotifTime
+                else:
+                    arrival = time.perf_counter()
+                streams[data[0]].append(data, arrival)
+
+            if onData != None:
+                onData(data)
+
+        return temp
+
+    def read(self):
+        now = time.perf_counter()
+        empty = (np.empty(0), np.empty((0, len(self.columns))))
+
+        for s in self.streams:
+            s.collect()
+            s.clock.fit()
+
+        if self._nextTime == None:
+            # Streams that stay silent are covered by maxLatency and come out as NaN
+            started = [s for s in self.streams if s._count > 0]
+            if len(started) == 0:
+                return empty
+            self._nextTime = max(s.firstTime() for s in started)
+
+        lastTimes = [s.lastTime() for s in self.streams]
+        step = self.blockSize / self.rate
+        blocks = 0
+
+        while True:
+            blockEnd = self._nextTime + blocks * step + (self.blockSize - 1) / self.rate
+            complete = all(t != None and t >= blockEnd for t in lastTimes)
+
+            if not complete and now - blockEnd <= self.maxLatency:
+                break
+            blocks += 1
+
+        if blocks == 0:
+            return empty
+
+        grid = self._nextTime + np.arange(blocks * self.blockSize) / self.rate
+        data = np.concatenate([s.sample(grid) for s in self.streams], axis=1)
+
+        self._nextTime += blocks * step
+        for s in self.streams:
+            s.trim(self._nextTime)
+
+        return grid, data
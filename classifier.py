@@ -0,0 +1,251 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import struct
+import time
+from collections import deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from emg import decodeEmgPacket, emgMidScale
+from gforce import NotifDataType
+
+# Time domain features computed per channel on every window
+#   mav: mean absolute value
+#   rms: root mean square
+#   wl:  waveform length
+#   zc:  zero crossings
+#   ssc: slope sign changes
+DEFAULT_FEATURES = ("mav", "wl", "zc", "ssc")
+
+
+# Compute features for a (windows, samples, channels) batch.
+# Returns (windows, len(features) * channels), ordered feature by feature.
+def extractFeatures(windows, features=DEFAULT_FEATURES, threshold=0.0):
+    result = []
+
+    for name in features:
+        if name == "mav":
+            result.append(np.abs(windows).mean(axis=1))
+        elif name == "rms":
+            result.append(np.sqrt(np.square(windows).mean(axis=1)))
+        elif name == "wl":
+            result.append(np.abs(np.diff(windows, axis=1)).sum(axis=1))
+        elif name == "zc":
+            a = windows[:, :-1]
+            b = windows[:, 1:]
+            result.append(((a * b < 0) & (np.abs(a - b) >= threshold)).sum(axis=1))
+        elif name == "ssc":
+            d1 = windows[:, 1:-1] - windows[:, :-2]
+            d2 = windows[:, 1:-1] - windows[:, 2:]
+            result.append((d1 * d2 > threshold).sum(axis=1))
+        else:
+            raise ValueError("Unknown feature: {0}".format(name))
+
+    return np.concatenate(result, axis=1).astype(np.float32)
+
+
+class _Model:
+    def __init__(self, mean=None, scale=None):
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+
+    def _normalize(self, x):
+        if self.mean is not None:
+            x = x - self.mean
+        if self.scale is not None:
+            x = x / self.scale
+        return x
+
+
+# Linear model: scores = x @ weights + bias, weights is (features, classes)
+class LinearModel(_Model):
+    def __init__(self, weights, bias, mean=None, scale=None):
+        super().__init__(mean, scale)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+
+    def predict(self, x):
+        return self._normalize(x) @ self.weights + self.bias
+
+
+# Linear discriminant analysis with a shared covariance, means is (classes, features)
+class LdaModel(LinearModel):
+    def __init__(self, means, covariance, priors=None, mean=None, scale=None):
+        means = np.asarray(means, dtype=np.float64)
+        covInv = np.linalg.pinv(np.asarray(covariance, dtype=np.float64))
+
+        if priors is None:
+            priors = np.full(len(means), 1.0 / len(means))
+
+        weights = covInv @ means.T
+        bias = -0.5 * np.einsum("ij,ji->i", means, weights) + np.log(priors)
+        super().__init__(weights, bias, mean, scale)
+
+
+# Multi layer perceptron, layers is a list of (weights, bias) with weights (inputs, outputs).
+# The activation is applied between layers, the last layer outputs the class scores.
+class MlpModel(_Model):
+    def __init__(self, layers, activation="relu", mean=None, scale=None):
+        super().__init__(mean, scale)
+        self.layers = [(np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32)) for w, b in layers]
+
+        if activation == "relu":
+            self.activation = lambda x: np.maximum(x, 0, out=x)
+        elif activation == "tanh":
+            self.activation = lambda x: np.tanh(x, out=x)
+        else:
+            raise ValueError("Unknown activation: {0}".format(activation))
+
+    def predict(self, x):
+        x = self._normalize(x)
+        last = len(self.layers) - 1
+
+        for i, (w, b) in enumerate(self.layers):
+            x = x @ w + b
+            if i != last:
+                x = self.activation(x)
+
+        return x
+
+
+# Classify gestures on the host from the NTF_EMG_ADC_DATA stream.
+#
+# Feed onData with the packets GForceProfile delivers. Every hop samples a window
+# of the last `window` samples is classified; all windows completed by a packet
+# are classified in one batch. Each decision is delivered to onGesture as a
+# NTF_EMG_GEST_DATA packet, [type, gesture] or, with withStrength, [type, gesture,
+# strength(uint16)] where strength is the mean absolute value in 1/1000 of half scale.
+#
+# Latency is measured from the arrival of the notification that completed a window
+# (profile.lastNotifTime when a profile is given) to the decision.
+class GestureClassifier:
+    def __init__(
+        self,
+        model,
+        channels,
+        resolution=8,
+        window=200,
+        hop=25,
+        features=DEFAULT_FEATURES,
+        threshold=0.0,
+        gestureIds=None,
+        withStrength=False,
+        onlyChanges=False,
+        profile=None,
+        onGesture=None,
+        onData=None,
+    ):
+        self.model = model
+        self.channels = channels
+        self.resolution = resolution
+        self.window = window
+        self.hop = hop
+        self.features = features
+        self.threshold = threshold
+        self.gestureIds = gestureIds
+        self.withStrength = withStrength
+        self.onlyChanges = onlyChanges
+        self.profile = profile
+        self.onGesture = onGesture
+        # Receives every packet after classification, to chain another consumer
+        self.nextOnData = onData
+
+        self.lastGesture = None
+        self.lastLatency = None
+        self.latencies = deque(maxlen=1000)
+        self.decisions = 0
+
+        self._offset = emgMidScale(resolution)
+        self._buf = np.zeros((window + 4 * hop, channels), dtype=np.float32)
+        self._len = 0
+        # Sample index in _buf where the next window starts
+        self._next = 0
+
+    def reset(self):
+        self._len = 0
+        self._next = 0
+        self.lastGesture = None
+
+    def onData(self, data):
+        if len(data) > 0 and data[0] == NotifDataType.NTF_EMG_ADC_DATA:
+            if self.profile != None:
+                arrival = self.profile.lastNotifTime
+            else:
+                arrival = time.perf_counter()
+
+            self._append(decodeEmgPacket(data, self.channels, self.resolution))
+            self._classify(arrival)
+
+        if self.nextOnData != None:
+            self.nextOnData(data)
+
+    def _append(self, samples):
+        n = len(samples)
+
+        if self._len + n > len(self._buf):
+            buf = np.zeros((self._len + n + self.window, self.channels), dtype=np.float32)
+            buf[: self._len] = self._buf[: self._len]
+            self._buf = buf
+
+        out = self._buf[self._len : self._len + n]
+        # Subtract in float, ADC codes are unsigned and would wrap
+        np.subtract(samples, self._offset, out=out, dtype=out.dtype, casting="unsafe")
+        self._len += n
+
+    def _classify(self, arrival):
+        if self._len - self._next < self.window:
+            return
+
+        windows = sliding_window_view(self._buf[self._next : self._len], self.window, axis=0)[:: self.hop]
+        # sliding_window_view puts the window axis last
+        windows = windows.transpose(0, 2, 1)
+        count = len(windows)
+
+        x = extractFeatures(windows, self.features, self.threshold)
+        classes = np.argmax(self.model.predict(x), axis=1)
+
+        if self.withStrength:
+            mav = np.abs(windows).mean(axis=(1, 2))
+            strengths = np.clip(mav * 1000 / self._offset, 0, 0xFFFF).astype(np.int64)
+
+        # Drop samples no later window needs
+        self._next += count * self.hop
+        self._buf[: self._len - self._next] = self._buf[self._next : self._len]
+        self._len -= self._next
+        self._next = 0
+
+        latency = time.perf_counter() - arrival
+        self.lastLatency = latency
+        self.latencies.append(latency)
+        self.decisions += count
+
+        for i in range(count):
+            gesture = int(classes[i])
+            if self.gestureIds is not None:
+                gesture = self.gestureIds[gesture]
+
+            if self.onlyChanges and gesture == self.lastGesture:
+                continue
+            self.lastGesture = gesture
+
+            if self.onGesture != None:
+                if self.withStrength:
+                    packet = struct.pack("<BBH", NotifDataType.NTF_EMG_GEST_DATA, gesture, strengths[i])
+                else:
+                    packet = struct.pack("<BB", NotifDataType.NTF_EMG_GEST_DATA, gesture)
+                self.onGesture(packet)
+
+    # Latency statistics in milliseconds over the last 1000 classified batches
+    def getLatencyStats(self):
+        if len(self.latencies) == 0:
+            return None
+
+        ms = np.asarray(self.latencies) * 1000
+        return {
+            "last": float(ms[-1]),
+            "mean": float(ms.mean()),
+            "p95": float(np.percentile(ms, 95)),
+            "max": float(ms.max()),
+        }
@@ -0,0 +1,216 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
+
+from gforce import GForceProfile
+
+# Seconds added to a command's device timeout while waiting for its response
+RESPONSE_MARGIN = 1.0
+
+
+# Blocking client for threaded, non-asyncio applications.
+#
+# One event loop runs for the lifetime of the client on a background thread and
+# owns the GForceProfile, so the connection survives between calls. Every method
+# blocks the calling thread until the coroutine on that loop finishes or timeout
+# seconds pass (concurrent.futures.TimeoutError).
+#
+# Commands return the response the device sent: the ResponseResult for set
+# commands, a tuple (resp, values...) for get commands, or a GF_RET_CODE when the
+# command could not be sent at all.
+#
+# Data packets go into a bounded queue; when it is full the oldest packet is
+# dropped and counted in self.dropped, so a slow consumer never stalls the loop.
+# Read them with read(), or pass onBatch to startDataNotification to receive
+# lists of packets on a dispatch thread.
+class GForceClient:
+    def __init__(self, timeout=10.0, queueSize=4096):
+        self.timeout = timeout
+        self.profile = GForceProfile()
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.dropped = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._runLoop, name="GForceClient", daemon=True)
+        self.thread.start()
+
+        self._dispatchThread = None
+        self._dispatchStop = threading.Event()
+
+    def _runLoop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _call(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        try:
+            return future.result(self.timeout if timeout == None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    # Send a command and wait for the values its callback receives
+    def _request(self, send, *args, timeout=1000):
+        return self._call(self.profile.request(send, *args, timeout=timeout), timeout / 1000 + RESPONSE_MARGIN)
+
+    def close(self):
+        self.stopDispatch()
+
+        if self.loop.is_running():
+            try:
+                self.disconnect()
+            except Exception as e:
+                print("GForceClient: disconnect failed: {0}".format(e))
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(self.timeout)
+
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def scan(self, timeout, name_prefix="", min_rssi=-128):
+        return self._call(self.profile.scan(timeout, name_prefix, min_rssi), timeout + self.timeout)
+
+    def connect(self, addr):
+        return self._call(self.profile.connect(addr))
+
+    def connectByRssi(self, timeout, name_prefix="", min_rssi=-128):
+        return self._call(self.profile.connectByRssi(timeout, name_prefix, min_rssi), timeout + self.timeout)
+
+    def disconnect(self):
+        return self._call(self.profile.disconnect())
+
+    def setDataNotifSwitch(self, flags, timeout=1000):
+        return self._request(self.profile.setDataNotifSwitch, flags, timeout=timeout)[0]
+
+    def setMotor(self, switchStatus, timeout=1000):
+        return self._request(self.profile.setMotor, switchStatus, timeout=timeout)[0]
+
+    def setLED(self, switchStatus, timeout=1000):
+        return self._request(self.profile.setLED, switchStatus, timeout=timeout)[0]
+
+    def setLogLevel(self, logLevel, timeout=1000):
+        return self._request(self.profile.setLogLevel, logLevel, timeout=timeout)[0]
+
+    def setEmgRawDataConfig(self, sampRate, channelMask, dataLen, resolution, timeout=1000):
+        return self._request(
+            self.profile.setEmgRawDataConfig, sampRate, channelMask, dataLen, resolution, timeout=timeout
+        )[0]
+
+    # Returns (resp, sampRate, channelMask, dataLen, resolution)
+    def getEmgRawDataConfig(self, timeout=1000):
+        return self._request(self.profile.getEmgRawDataConfig, timeout=timeout)
+
+    # Returns (resp, featureMap)
+    def getFeatureMap(self, timeout=1000):
+        return self._request(self.profile.getFeatureMap, timeout=timeout)
+
+    # Returns (resp, firmwareVersion)
+    def getControllerFirmwareVersion(self, timeout=1000):
+        return self._request(self.profile.getControllerFirmwareVersion, timeout=timeout)
+
+    # Returns (resp, batteryLevel)
+    def getBatteryLevel(self, timeout=1000):
+        return self._request(self.profile.getBatteryLevel, timeout=timeout)
+
+    # Returns (resp, temperature)
+    def getTemperature(self, timeout=1000):
+        return self._request(self.profile.getTemperature, timeout=timeout)
+
+    def startTelemetry(self, interval=60, idleGap=0.5, timeout=1000):
+        self.loop.call_soon_threadsafe(self.profile.startTelemetry, interval, idleGap, timeout)
+
+    def stopTelemetry(self):
+        self.loop.call_soon_threadsafe(self.profile.stopTelemetry)
+
+    # The device does not answer these, so only the send result is returned
+    def powerOff(self, timeout=1000):
+        return self._call(self.profile.powerOff(timeout))
+
+    def systemReset(self, timeout=1000):
+        return self._call(self.profile.systemReset(timeout))
+
+    # Start streaming into the queue. With onBatch, a dispatch thread calls
+    # onBatch(packets) with up to batchSize packets, at least every batchTime ms
+    # while data flows.
+    def startDataNotification(self, onBatch=None, batchSize=64, batchTime=10):
+        if onBatch != None:
+            self._startDispatch(onBatch, batchSize, batchTime)
+
+        return self._call(self.profile.startDataNotification(self._onData))
+
+    def stopDataNotification(self):
+        ret = self._call(self.profile.stopDataNotification())
+        self.stopDispatch()
+        return ret
+
+    # Runs on the event loop thread
+    def _onData(self, data):
+        packet = bytes(data)
+
+        try:
+            self.queue.put_nowait(packet)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(packet)
+
+    # Return up to maxPackets queued packets, waiting up to timeout seconds for the first
+    def read(self, maxPackets=None, timeout=None):
+        packets = []
+
+        try:
+            packets.append(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            return packets
+
+        while maxPackets == None or len(packets) < maxPackets:
+            try:
+                packets.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return packets
+
+    def _startDispatch(self, onBatch, batchSize, batchTime):
+        self.stopDispatch()
+        self._dispatchStop.clear()
+
+        def dispatch():
+            while not self._dispatchStop.is_set():
+                packets = self.read(batchSize, timeout=0.1)
+                if len(packets) == 0:
+                    continue
+
+                # Wait for a fuller batch, but never longer than batchTime
+                deadline = time.monotonic() + batchTime / 1000
+                while len(packets) < batchSize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    packets += self.read(batchSize - len(packets), timeout=remaining)
+
+                onBatch(packets)
+
+        self._dispatchThread = threading.Thread(target=dispatch, name="GForceClientDispatch", daemon=True)
+        self._dispatchThread.start()
+
+    def stopDispatch(self):
+        if self._dispatchThread != None:
+            self._dispatchStop.set()
+            if self._dispatchThread != threading.current_thread():
+                self._dispatchThread.join()
+            self._dispatchThread = None
@@ -0,0 +1,70 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import numpy as np
+
+# emgChannelCount lives next to EmgRawDataConfig and is re-exported here
+from gforce import NotifDataType, emgChannelCount  # noqa: F401
+
+
+# Largest ADC code for a resolution of setEmgRawDataConfig
+def emgFullScale(resolution):
+    return (1 << resolution) - 1
+
+
+# ADC code of a zero input, EMG samples are unsigned with a mid-scale offset
+def emgMidScale(resolution):
+    return 1 << (resolution - 1)
+
+
+# Decode a NTF_EMG_ADC_DATA packet into a (samples, channels) array of ADC codes.
+#
+# The payload repeats CH0~CHn, one byte per channel in 8 bit mode and two bytes
+# in LSB order per channel for higher resolutions. The result is a view on the
+# packet when it is a bytes-like object, so copy it if it must outlive the packet.
+def decodeEmgPacket(data, channels, resolution):
+    if isinstance(data, list):
+        raw = np.asarray(data, dtype=np.uint8)
+    else:
+        raw = np.frombuffer(data, dtype=np.uint8)
+
+    raw = raw[1:]
+
+    if resolution > 8:
+        samples = raw[: len(raw) // 2 * 2].view("<u2")
+    else:
+        samples = raw
+
+    count = len(samples) // channels
+    return samples[: count * channels].reshape(count, channels)
+
+
+# Decode the NTF_EMG_ADC_DATA packets of a batch delivered by
+# startDataNotification in batched mode into one (samples, channels) array.
+# Equal length packets, the normal case, are decoded in a single pass.
+def decodeEmgBatch(buffer, offsets, types, channels, resolution):
+    offsets = np.frombuffer(offsets, dtype=np.uint32)
+    types = np.frombuffer(types, dtype=np.uint8)
+    starts = offsets[:-1][types == NotifDataType.NTF_EMG_ADC_DATA]
+    ends = offsets[1:][types == NotifDataType.NTF_EMG_ADC_DATA]
+
+    if len(starts) == 0:
+        return np.empty((0, channels), dtype=np.uint16 if resolution > 8 else np.uint8)
+
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    lengths = ends - starts
+
+    if np.all(lengths == lengths[0]):
+        # Gather the payloads without their type byte into one block
+        index = starts[:, None] + 1 + np.arange(lengths[0] - 1)
+        payload = raw[index].reshape(-1)
+    else:
+        payload = np.concatenate([raw[s + 1 : e] for s, e in zip(starts, ends)])
+
+    if resolution > 8:
+        samples = payload[: len(payload) // 2 * 2].view("<u2")
+    else:
+        samples = payload
+
+    count = len(samples) // channels
+    return samples[: count * channels].reshape(count, channels)
@@ -0,0 +1,222 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import asyncio
+import math
+import time
+
+from gforce import EmgRawDataConfig, NotifDataType, ResponseResult, emgChannelCount
+
+# Bytes added to every notification by the ATT (3) and L2CAP (4) headers
+LINK_OVERHEAD = 7
+# [NTF_PARTIAL_DATA, packet number] header of a fragmented notification
+PARTIAL_HEADER = 2
+
+
+# NTF_EMG_ADC_DATA packets per second an EMG raw data config produces
+def _packetRate(config):
+    bytesPerSample = 1 if config.resolution <= 8 else 2
+    return config.sampRate * emgChannelCount(config.channelMask) * bytesPerSample / config.dataLen
+
+
+# Link bytes per second needed to deliver an EMG raw data config over a connection with mtu
+def predictEmgBandwidth(config, mtu):
+    return _packetRate(config) * _linkBytesPerPacket(config.dataLen, mtu)
+
+
+def _linkBytesPerPacket(dataLen, mtu):
+    packetLen = dataLen + 1
+    attPayload = mtu - 3
+
+    if packetLen <= attPayload:
+        return packetLen + LINK_OVERHEAD
+
+    fragments = math.ceil(packetLen / (attPayload - PARTIAL_HEADER))
+    return packetLen + fragments * (PARTIAL_HEADER + LINK_OVERHEAD)
+
+
+# Config of one ladder rung. dataLen is rounded down to a whole number of samples
+# of the enabled channels, so packets never grow and always split into samples.
+def _rung(sampRate, channelMask, dataLen, resolution):
+    sampleBytes = emgChannelCount(channelMask) * (1 if resolution <= 8 else 2)
+    return EmgRawDataConfig(sampRate, channelMask, dataLen // sampleBytes * sampleBytes, resolution)
+
+
+# Adapt the EMG raw data config to what the link actually delivers.
+#
+# Feed onData with the packets GForceProfile delivers and run() the controller.
+# Every interval seconds it compares the NTF_EMG_ADC_DATA packets received with
+# those the current config should produce. When loss exceeds lossHigh the link
+# capacity is taken as the delivered rate and the config steps down; when loss
+# stays below lossLow for holdIntervals and the next better config is predicted
+# to fit in headroom of the capacity, it steps back up. The capacity estimate
+# grows by probe per good interval so a recovered link is found again.
+#
+# Configs form a ladder of decreasing bandwidth: resolution is given up first, then
+# sample rate, then the highest enabled channels down to minChannels. Every rung
+# passes EmgRawDataConfig.validate(), see _rung().
+# onConfigChanged(old, new, reason) is called after the device accepted a change.
+class EmgConfigController:
+    def __init__(
+        self,
+        profile,
+        config,
+        sampRates=(1000, 500, 250, 200, 100),
+        resolutions=(12, 8),
+        minChannels=None,
+        interval=2.0,
+        lossHigh=0.05,
+        lossLow=0.01,
+        headroom=0.8,
+        holdIntervals=3,
+        probe=0.1,
+        linkCapacity=None,
+        timeout=1000,
+        onConfigChanged=None,
+        onData=None,
+    ):
+        self.profile = profile
+        self.interval = interval
+        self.lossHigh = lossHigh
+        self.lossLow = lossLow
+        self.headroom = headroom
+        self.holdIntervals = holdIntervals
+        self.probe = probe
+        self.linkCapacity = linkCapacity
+        self.timeout = timeout
+        self.onConfigChanged = onConfigChanged
+        self.nextOnData = onData
+
+        errors = config.validate()
+        if len(errors) > 0:
+            raise ValueError("EmgConfigController: {0}: {1}".format(config, ", ".join(errors)))
+
+        self.ladder = self._buildLadder(config, sampRates, resolutions, minChannels)
+        self.level = self.ladder.index(config)
+        self.config = config
+
+        self.byteRate = 0.0
+        self.packetLoss = 0.0
+
+        self._packets = 0
+        self._bytes = 0
+        # time.monotonic() the current measurement interval started
+        self._intervalStart = None
+        self._goodIntervals = 0
+        self._task = None
+
+    # Every config within the bounds, best first. config is the upper bound.
+    @staticmethod
+    def _buildLadder(config, sampRates, resolutions, minChannels):
+        rates = sorted(set([r for r in sampRates if r <= config.sampRate] + [config.sampRate]), reverse=True)
+        res = sorted(set([r for r in resolutions if r <= config.resolution] + [config.resolution]), reverse=True)
+
+        if minChannels == None:
+            minChannels = emgChannelCount(config.channelMask)
+
+        masks = [config.channelMask]
+        mask = config.channelMask
+        while emgChannelCount(mask) > max(minChannels, 1):
+            # Drop the highest enabled channel
+            mask &= ~(1 << (mask.bit_length() - 1))
+            masks.append(mask)
+
+        # Step one dimension down to its floor before touching the next
+        ladder = [_rung(rates[0], masks[0], config.dataLen, b) for b in res]
+        ladder += [_rung(r, masks[0], config.dataLen, res[-1]) for r in rates[1:]]
+        ladder += [_rung(rates[-1], m, config.dataLen, res[-1]) for m in masks[1:]]
+        # Rungs the device would reject, e.g. too few bytes for one sample, are left out
+        ladder = [c for c in ladder if len(c.validate()) == 0]
+        return ladder
+
+    def onData(self, data):
+        if len(data) > 0 and data[0] == NotifDataType.NTF_EMG_ADC_DATA:
+            self._packets += 1
+            self._bytes += len(data)
+
+        if self.nextOnData != None:
+            self.nextOnData(data)
+
+    async def run(self):
+        self._restartInterval()
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            now = time.monotonic()
+            elapsed = now - self._intervalStart
+            self._intervalStart = now
+            packets, self._packets = self._packets, 0
+            received, self._bytes = self._bytes, 0
+
+            await self._evaluate(packets, received, elapsed)
+
+    def _restartInterval(self):
+        self._intervalStart = time.monotonic()
+        self._packets = 0
+        self._bytes = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self._task != None:
+            self._task.cancel()
+        self._task = None
+
+    async def _evaluate(self, packets, received, elapsed):
+        mtu = self.profile.mtu or 23
+        c = self.config
+        expected = _packetRate(c) * elapsed
+
+        self.byteRate = received / elapsed
+        self.packetLoss = max(0.0, 1.0 - packets / expected) if expected > 0 else 0.0
+
+        if self.packetLoss > self.lossHigh:
+            delivered = packets / elapsed * _linkBytesPerPacket(c.dataLen, mtu)
+            if self.linkCapacity == None or delivered < self.linkCapacity:
+                self.linkCapacity = delivered
+
+            self._goodIntervals = 0
+            target = self.level + 1
+            while target < len(self.ladder) and predictEmgBandwidth(self.ladder[target], mtu) > self.linkCapacity:
+                target += 1
+
+            if target < len(self.ladder):
+                await self._apply(target, "packet loss {0:.1%}".format(self.packetLoss))
+
+        elif self.packetLoss < self.lossLow:
+            self._goodIntervals += 1
+            # Let a stale capacity estimate recover so better configs get probed again
+            if self.linkCapacity != None:
+                self.linkCapacity *= 1 + self.probe
+
+            if self._goodIntervals >= self.holdIntervals and self.level > 0:
+                candidate = self.ladder[self.level - 1]
+
+                if self.linkCapacity == None or predictEmgBandwidth(candidate, mtu) <= self.linkCapacity * self.headroom:
+                    self._goodIntervals = 0
+                    await self._apply(self.level - 1, "link has headroom")
+        else:
+            self._goodIntervals = 0
+
+    async def _apply(self, level, reason):
+        new = self.ladder[level]
+        errors = new.validate()
+        if len(errors) > 0:
+            print("EmgConfigController: {0} not sent: {1}".format(new, ", ".join(errors)))
+            return
+
+        resp = (await self.profile.request(self.profile.setEmgRawDataConfig, *new.astuple(), timeout=self.timeout))[0]
+        if resp != ResponseResult.RSP_CODE_SUCCESS:
+            print("EmgConfigController: {0} not applied: {1}".format(new, resp))
+            return
+
+        old = self.config
+        self.config = new
+        self.level = level
+        # Packets of the old config and the response round trip must not count against the new one
+        self._restartInterval()
+
+        if self.onConfigChanged != None:
+            self.onConfigChanged(old, new, reason)
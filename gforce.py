@@ -4,10 +4,12 @@
 import struct
 import threading
 import time
+from array import array
 from datetime import datetime, timedelta
 
 import asyncio
-from bleak import BleakClient, BleakScanner, BleakGATTCharacteristic
+
+# bleak is imported where it is used, so importing this module stays cheap
 
 
 class GF_RET_CODE(int):
@@ -190,6 +192,57 @@ class CommandCallbackTableEntry:
         self._cb = _cb
 
 
+# Number of enabled channels in a channelMask of setEmgRawDataConfig
+def emgChannelCount(channelMask):
+    return bin(channelMask & 0xFFFF).count("1")
+
+
+class EmgRawDataConfig:
+    def __init__(self, sampRate, channelMask, dataLen, resolution):
+        self.sampRate = sampRate
+        self.channelMask = channelMask
+        self.dataLen = dataLen
+        self.resolution = resolution
+
+    def __eq__(self, other):
+        return isinstance(other, EmgRawDataConfig) and self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return "EmgRawDataConfig(sampRate={0}, channelMask={1}, dataLen={2}, resolution={3})".format(
+            self.sampRate, hex(self.channelMask), self.dataLen, self.resolution
+        )
+
+    def astuple(self):
+        return (self.sampRate, self.channelMask, self.dataLen, self.resolution)
+
+    # List of problems, empty when the config can be sent. dataLen must hold a whole
+    # number of samples of all enabled channels.
+    def validate(self):
+        errors = []
+        channels = emgChannelCount(self.channelMask)
+        bytesPerSample = 1 if self.resolution <= 8 else 2
+
+        if not 0 < self.sampRate <= 0xFFFF:
+            errors.append("sampRate {0} out of range".format(self.sampRate))
+        if channels == 0 or self.channelMask & ~0xFFFF:
+            errors.append("bad channelMask {0}".format(hex(self.channelMask)))
+        if self.resolution not in (8, 12):
+            errors.append("resolution must be 8 or 12, got {0}".format(self.resolution))
+        if not 0 < self.dataLen <= 0xFF:
+            errors.append("dataLen {0} out of range".format(self.dataLen))
+        elif channels > 0 and self.dataLen % (channels * bytesPerSample) != 0:
+            errors.append(
+                "dataLen {0} is not a multiple of {1} channels x {2} bytes".format(
+                    self.dataLen, channels, bytesPerSample
+                )
+            )
+
+        return errors
+
+
 class GForceProfile:
     def __init__(self):
         self.device = None
@@ -205,14 +258,50 @@ class GForceProfile:
         self.incompleteNotifPacket = []
         self.lastIncompleteNotifPacketId = 0
         self.onData = None
+        # Called with every BLE notification before partial packets are reassembled
+        self.onRawData = None
+        # time.perf_counter() of the latest data notification, valid inside onData
+        self.lastNotifTime = 0
+        # Last EMG raw data config, notification flags and session profile the device accepted
+        self.emgRawDataConfig = None
+        self.dataNotifFlags = None
+        self.sessionProfile = None
+        # Latest telemetry, see startTelemetry(). telemetryTime holds the time.monotonic()
+        # of the last update of "battery", "temperature" and "status"
+        self.batteryLevel = None
+        self.temperature = None
+        self.deviceStatus = None
+        self.telemetryTime = {}
+        # Exception of the last failed poll of "battery" or "temperature"
+        self.telemetryErrors = {}
+        # Called with this profile when the device disconnects, see handle_disconnect()
+        self.onDisconnect = None
+        self.telemetryTask = None
+        # time.monotonic() of the last command sent
+        self.lastCommandTime = 0
+        # Batched delivery, see startDataNotification()
+        self.batchPackets = None
+        self.batchTime = None
+        self.batchTimeByType = {}
+        self.batchBuffer = bytearray()
+        self.batchOffsets = array("I", [0])
+        self.batchTypes = bytearray()
+        self.batchDeadline = None
+        self.batchTimer = None
+        self.loop = None
         self.lock = threading.Lock()
 
-    def handle_disconnect(_: BleakClient):
-        for task in asyncio.all_tasks():
-            task.cancel()
+    # Called by bleak when the connection is lost, and after disconnect()
+    def handle_disconnect(self, client):
+        self.state = BluetoothDeviceState.disconnected
+        self.stopTelemetry()
+        if self.onDisconnect != None:
+            self.onDisconnect(self)
 
     # Establishes a connection to the Bluetooth Device.
     async def connect(self, addr):
+        from bleak import BleakClient
+
         self.device = BleakClient(addr, disconnected_callback=self.handle_disconnect)
         await self.device.connect()
 
@@ -245,6 +334,8 @@ class GForceProfile:
         dev_addr = rssi_devices[max(rssi)]
 
         # connect the bracelet
+        from bleak import BleakClient
+
         self.device = BleakClient(dev_addr, disconnected_callback=self.handle_disconnect)
         await self.device.connect()
         print("connection succeeded")
@@ -265,6 +356,8 @@ class GForceProfile:
 
     async def scan(self, timeout, name_prefix="", min_rssi=-128):
         # Scan for devices
+        from bleak import BleakScanner
+
         scanner = BleakScanner(service_uuids=[SERVICE_GUID])
         await scanner.start()
         time.sleep(timeout)
@@ -286,6 +379,8 @@ class GForceProfile:
 
     # Disconnect from device
     async def disconnect(self):
+        self.stopTelemetry()
+
         if self.timer != None:
             self.timer.cancel()
         self.timer = None
@@ -295,7 +390,7 @@ class GForceProfile:
             return True
         else:
             await self.device.disconnect()
-            self.state == BluetoothDeviceState.disconnected
+            self.state = BluetoothDeviceState.disconnected
 
     # Set data notification flag
     async def setDataNotifSwitch(self, flags, cb, timeout):
@@ -309,6 +404,8 @@ class GForceProfile:
         data = bytes(data)
 
         def temp(resp, respData):
+            if resp == ResponseResult.RSP_CODE_SUCCESS:
+                self.dataNotifFlags = flags
             if cb != None:
                 cb(resp)
 
@@ -407,6 +504,51 @@ class GForceProfile:
         data += struct.pack("<B", resolution)
 
         def temp(resp, raspData):
+            if resp == ResponseResult.RSP_CODE_SUCCESS:
+                self.emgRawDataConfig = EmgRawDataConfig(sampRate, channelMask, dataLen, resolution)
+            if cb != None:
+                cb(resp)
+
+        # Send data
+        return await self.sendCommand(ProfileCharType.PROF_DATA_CMD, data, True, temp, timeout)
+
+    # Set Accelerate Config, fullScale in g
+    async def setAccelerateConfig(self, sampRate, fullScale, dataLen, cb, timeout):
+        data = struct.pack("<BHBB", CommandType.CMD_SET_ACCELERATE_CONFIG, sampRate, fullScale, dataLen)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Set Gyroscope Config, fullScale in dps
+    async def setGyroscopeConfig(self, sampRate, fullScale, dataLen, cb, timeout):
+        data = struct.pack("<BHHB", CommandType.CMD_SET_GYROSCOPE_CONFIG, sampRate, fullScale, dataLen)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Set Magnetometer Config, fullScale in uT
+    async def setMagnetometerConfig(self, sampRate, fullScale, dataLen, cb, timeout):
+        data = struct.pack("<BHHB", CommandType.CMD_SET_MAGNETOMETER_CONFIG, sampRate, fullScale, dataLen)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Set Euler Angle Config
+    async def setEulerAngleConfig(self, sampRate, cb, timeout):
+        data = struct.pack("<BH", CommandType.CMD_SET_EULER_ANGLE_CONFIG, sampRate)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Set Quaternion Config
+    async def setQuaternionConfig(self, sampRate, cb, timeout):
+        data = struct.pack("<BH", CommandType.CMD_SET_QUATERNION_CONFIG, sampRate)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Set Rotation Matrix Config
+    async def setRotationMatrixConfig(self, sampRate, cb, timeout):
+        data = struct.pack("<BH", CommandType.CMD_SET_ROTATION_MATRIX_CONFIG, sampRate)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    # Enable or disable the packet id in data notifications
+    async def setPackageIdControl(self, enable, cb, timeout):
+        data = struct.pack("<BB", CommandType.CMD_PACKAGE_ID_CONTROL, 0x01 if enable else 0x00)
+        return await self._sendSetCommand(data, cb, timeout)
+
+    async def _sendSetCommand(self, data, cb, timeout):
+        def temp(resp, respData):
             if cb != None:
                 cb(resp)
 
@@ -426,6 +568,7 @@ class GForceProfile:
                     cb(resp, None, None, None, None)
                 elif len(respData) == 6:
                     sampRate, channelMask, dataLen, resolution = struct.unpack_from("@HHBB", respData)
+                    self.emgRawDataConfig = EmgRawDataConfig(sampRate, channelMask, dataLen, resolution)
                 cb(resp, sampRate, channelMask, dataLen, resolution)
 
         return await self.sendCommand(ProfileCharType.PROF_DATA_CMD, data, True, temp, timeout)
@@ -469,6 +612,95 @@ class GForceProfile:
 
         return await self.sendCommand(ProfileCharType.PROF_DATA_CMD, data, True, temp, timeout)
 
+    # Get battery level in percent
+    async def getBatteryLevel(self, cb, timeout):
+        # Pack data
+        data = []
+        data.append(CommandType.CMD_GET_BATTERY_LEVEL)
+        data = bytes(data)
+
+        def temp(resp, respData):
+            batteryLevel = None
+            if resp == ResponseResult.RSP_CODE_SUCCESS and len(respData) >= 1:
+                batteryLevel = respData[0]
+                self.batteryLevel = batteryLevel
+                self.telemetryTime["battery"] = time.monotonic()
+
+            if cb != None:
+                cb(resp, batteryLevel)
+
+        return await self.sendCommand(ProfileCharType.PROF_DATA_CMD, data, True, temp, timeout)
+
+    # Get device temperature in degrees Celsius
+    async def getTemperature(self, cb, timeout):
+        # Pack data
+        data = []
+        data.append(CommandType.CMD_GET_TEMPERATURE)
+        data = bytes(data)
+
+        def temp(resp, respData):
+            temperature = None
+            if resp == ResponseResult.RSP_CODE_SUCCESS and len(respData) >= 1:
+                temperature = struct.unpack_from("<b", bytes(respData))[0]
+                self.temperature = temperature
+                self.telemetryTime["temperature"] = time.monotonic()
+
+            if cb != None:
+                cb(resp, temperature)
+
+        return await self.sendCommand(ProfileCharType.PROF_DATA_CMD, data, True, temp, timeout)
+
+    # Keep batteryLevel, temperature and deviceStatus current.
+    #
+    # deviceStatus follows NTF_DEV_STATUS notifications, enable DNF_DEVICE_STATUS
+    # to receive them. Battery level and temperature are polled every interval
+    # seconds, but only once no command is pending and none was sent for idleGap
+    # seconds, so polls never queue up behind or delay user commands. A poll that
+    # raises is logged, kept in telemetryErrors until it succeeds again, and retried.
+    def startTelemetry(self, interval=60, idleGap=0.5, timeout=1000):
+        self.stopTelemetry()
+        self.telemetryTask = asyncio.ensure_future(self._telemetryLoop(interval, idleGap, timeout))
+
+    def stopTelemetry(self):
+        if self.telemetryTask != None:
+            self.telemetryTask.cancel()
+        self.telemetryTask = None
+
+    def _isIdle(self, idleGap):
+        return len(self.cmdMap) == 0 and time.monotonic() - self.lastCommandTime >= idleGap
+
+    async def _telemetryLoop(self, interval, idleGap, timeout):
+        polls = [("battery", self.getBatteryLevel), ("temperature", self.getTemperature)]
+        # Time of the last poll, so failed polls are not retried before interval
+        lastPoll = {}
+
+        while True:
+            now = time.monotonic()
+            nextPoll = now + interval
+
+            for name, get in polls:
+                last = max(lastPoll.get(name, now - interval), self.telemetryTime.get(name, now - interval))
+                due = last + interval
+
+                if due > now:
+                    nextPoll = min(nextPoll, due)
+                    continue
+
+                while not self._isIdle(idleGap):
+                    await asyncio.sleep(idleGap / 2)
+
+                # The response updates the attribute, no need to wait for it here
+                lastPoll[name] = time.monotonic()
+                try:
+                    await get(None, timeout)
+                    self.telemetryErrors.pop(name, None)
+                except Exception as e:
+                    # Keep polling, a failed write must not end telemetry for good
+                    print("Telemetry: {0} poll failed: {1!r}".format(name, e))
+                    self.telemetryErrors[name] = e
+
+            await asyncio.sleep(max(nextPoll - time.monotonic(), idleGap))
+
     async def sendCommand(self, profileCharType, data, hasResponse, cb, timeout):
         if hasResponse and cb != None:
             cmd = data[0]
@@ -482,38 +714,73 @@ class GForceProfile:
             self._refreshTimer()
             self.lock.release()
 
+        self.lastCommandTime = time.monotonic()
+
         if profileCharType == ProfileCharType.PROF_DATA_CMD:
             if self.cmdCharacteristic == None:
                 return GF_RET_CODE.GF_ERROR_BAD_STATE
             else:
-                if len(data) > self.mtu:
-                    contentLen = self.mtu - 2
-                    packetCount = (len(data) + contentLen - 1) // contentLen
-                    startIndex = 0
-                    buf = []
-
-                    for i in range(packetCount - 1, 0, -1):
-                        buf.append(CommandType.CMD_PARTIAL_DATA)
-                        buf.append(i)
-                        buf += data[startIndex : startIndex + contentLen]
-                        startIndex += contentLen
-                        # self.send_queue.put_nowait(buf)
-                        await self.device.write_gatt_char(self.cmdCharacteristic, buf)
-                        buf.clear()
-                    # Packet end
-                    buf.append(CommandType.CMD_PARTIAL_DATA)
-                    buf.append(0)
-                    buf += data[startIndex:]
-                    # self.send_queue.put_nowait(buf)
-                    await self.device.write_gatt_char(self.cmdCharacteristic, buf)
-                else:
-                    # self.send_queue.put_nowait(data)
-                    await self.device.write_gatt_char(self.cmdCharacteristic, data)
+                try:
+                    await self._writeCommand(data)
+                except Exception:
+                    # No response will come, do not leave the entry to time out later
+                    if hasResponse and cb != None:
+                        self.lock.acquire()
+                        if self.cmdMap.get(data[0]) != None and self.cmdMap[data[0]]._cb == cb:
+                            del self.cmdMap[data[0]]
+                            self._refreshTimer()
+                        self.lock.release()
+                    raise
 
                 return GF_RET_CODE.GF_SUCCESS
         else:
             return GF_RET_CODE.GF_ERROR_BAD_PARAM
 
+    # Call send(*args, cb, timeout), one of the commands above, and wait for its
+    # response. Returns the values cb receives, e.g. (resp,) or (resp, batteryLevel),
+    # or (ret,) with the GF_RET_CODE of send when the command could not be sent.
+    async def request(self, send, *args, timeout=1000):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def setResult(values):
+            if not future.done():
+                future.set_result(values)
+
+        # Responses arrive on the BLE callback or the timeout timer thread
+        def temp(*values):
+            loop.call_soon_threadsafe(setResult, values)
+
+        ret = await send(*args, temp, timeout)
+        if ret != GF_RET_CODE.GF_SUCCESS:
+            return (ret,)
+        return await future
+
+    async def _writeCommand(self, data):
+        if len(data) > self.mtu:
+            contentLen = self.mtu - 2
+            packetCount = (len(data) + contentLen - 1) // contentLen
+            startIndex = 0
+            buf = []
+
+            for i in range(packetCount - 1, 0, -1):
+                buf.append(CommandType.CMD_PARTIAL_DATA)
+                buf.append(i)
+                buf += data[startIndex : startIndex + contentLen]
+                startIndex += contentLen
+                # self.send_queue.put_nowait(buf)
+                await self.device.write_gatt_char(self.cmdCharacteristic, buf)
+                buf.clear()
+            # Packet end
+            buf.append(CommandType.CMD_PARTIAL_DATA)
+            buf.append(0)
+            buf += data[startIndex:]
+            # self.send_queue.put_nowait(buf)
+            await self.device.write_gatt_char(self.cmdCharacteristic, buf)
+        else:
+            # self.send_queue.put_nowait(data)
+            await self.device.write_gatt_char(self.cmdCharacteristic, data)
+
     # Refresh time,need external self.lock
     def _refreshTimer(self):
         def cmp_time(cb):
@@ -556,8 +823,26 @@ class GForceProfile:
             if cmd._cb != None:
                 cmd._cb(ResponseResult.RSP_CODE_TIMEOUT, None)
 
-    async def startDataNotification(self, onData):
+    # Start data notification, onData(packet) is called for every reassembled packet.
+    #
+    # Batched mode is enabled by batchPackets, batchTime or batchTimeByType. Packets
+    # are then collected and onData(buffer, offsets, types) is called with up to
+    # batchPackets packets: packet i is buffer[offsets[i]:offsets[i + 1]] and its
+    # NotifDataType is types[i]. A batch is delivered at the latest batchTime ms
+    # (10 by default) after its first packet arrived; batchTimeByType maps a
+    # NotifDataType to its own maximum added latency in ms.
+    async def startDataNotification(self, onData, batchPackets=None, batchTime=None, batchTimeByType=None):
+        # A batch left from a previous batched start still belongs to the old onData
+        self.flushDataBatch()
         self.onData = onData
+        self.loop = asyncio.get_running_loop()
+
+        if batchPackets != None or batchTime != None or batchTimeByType != None:
+            self.batchPackets = batchPackets if batchPackets != None else 0xFFFF
+            self.batchTime = batchTime if batchTime != None else 10
+            self.batchTimeByType = batchTimeByType if batchTimeByType != None else {}
+        else:
+            self.batchPackets = None
 
         try:
             await self.device.start_notify(self.notifyCharacteristic, self._handleDataNotification)
@@ -577,14 +862,21 @@ class GForceProfile:
         except:
             success = False
 
+        if self.batchPackets != None:
+            self.flushDataBatch()
+
         if success:
             return GF_RET_CODE.GF_SUCCESS
         else:
             return GF_RET_CODE.GF_ERROR_BAD_STATE
 
-    def _handleDataNotification(self, characteristic: BleakGATTCharacteristic, data: bytearray):
+    def _handleDataNotification(self, characteristic: "BleakGATTCharacteristic", data: bytearray):
+        self.lastNotifTime = time.perf_counter()
         fullPacket = []
 
+        if self.onRawData != None:
+            self.onRawData(data)
+
         if len(data) >= 2:
             if data[0] == NotifDataType.NTF_PARTIAL_DATA:
                 if self.lastIncompleteNotifPacketId != 0 and self.lastIncompleteNotifPacketId != data[1] + 1:
@@ -609,7 +901,50 @@ class GForceProfile:
                 fullPacket = data
 
         if len(fullPacket) > 0:
-            self.onData(fullPacket)
+            if fullPacket[0] == NotifDataType.NTF_DEV_STATUS:
+                self.deviceStatus = bytes(fullPacket[1:])
+                self.telemetryTime["status"] = time.monotonic()
+
+            if self.batchPackets != None:
+                self._batchPacket(fullPacket)
+            else:
+                self.onData(fullPacket)
+
+    def _batchPacket(self, packet):
+        self.batchBuffer += bytes(packet)
+        self.batchOffsets.append(len(self.batchBuffer))
+        self.batchTypes.append(packet[0])
+
+        if len(self.batchTypes) >= self.batchPackets:
+            self.flushDataBatch()
+            return
+
+        latency = self.batchTimeByType.get(packet[0], self.batchTime)
+        deadline = self.loop.time() + latency / 1000
+
+        if self.batchDeadline == None or deadline < self.batchDeadline:
+            self.batchDeadline = deadline
+            if self.batchTimer != None:
+                self.batchTimer.cancel()
+            self.batchTimer = self.loop.call_at(deadline, self.flushDataBatch)
+
+    # Deliver the pending batch now
+    def flushDataBatch(self):
+        if self.batchTimer != None:
+            self.batchTimer.cancel()
+        self.batchTimer = None
+        self.batchDeadline = None
+
+        if len(self.batchTypes) == 0:
+            return
+
+        buffer, offsets, types = self.batchBuffer, self.batchOffsets, self.batchTypes
+        # Hand the buffers over and start new ones instead of copying
+        self.batchBuffer = bytearray()
+        self.batchOffsets = array("I", [0])
+        self.batchTypes = bytearray()
+
+        self.onData(buffer, offsets, types)
 
     # Command notification callback
     def _onResponse(self, characteristic, data):
@@ -0,0 +1,358 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import math
+import struct
+import time
+
+import numpy as np
+
+from gforce import NotifDataType
+
+# NTF_QUAT_FLOAT_DATA payload: w, x, y, z
+QUAT_FORMAT = struct.Struct("<4f")
+# Assumed NTF_ACC_DATA / NTF_GYO_DATA / NTF_MAG_DATA payload: x, y, z. The protocol
+# does not document it, pass vectorFormat where the device sends something else.
+VECTOR_FORMAT = struct.Struct("<3i")
+# Default units of the vector payloads: g, degree/s and uT, in 1/65536 steps
+DEFAULT_VECTOR_SCALE = 1.0 / 65536
+
+
+# Convert (N, 4) quaternions in w, x, y, z order into (N, 3) Euler angles in degrees,
+# ordered pitch, roll, yaw like NTF_EULER_DATA.
+def quatToEuler(q):
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+
+    return np.degrees(np.stack((pitch, roll, yaw), axis=1))
+
+
+# Convert (N, 4) quaternions in w, x, y, z order into (N, 3, 3) rotation matrices
+def quatToRotationMatrix(q):
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    m = np.empty((len(q), 3, 3))
+    m[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    m[:, 0, 1] = 2 * (x * y - w * z)
+    m[:, 0, 2] = 2 * (x * z + w * y)
+    m[:, 1, 0] = 2 * (x * y + w * z)
+    m[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    m[:, 1, 2] = 2 * (y * z - w * x)
+    m[:, 2, 0] = 2 * (x * z - w * y)
+    m[:, 2, 1] = 2 * (y * z + w * x)
+    m[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return m
+
+
+# Spherical linear interpolation between (N, 4) quaternions q0 and q1 at fractions t (N,)
+def slerp(q0, q1, t):
+    q0 = np.asarray(q0, dtype=np.float64).reshape(-1, 4)
+    q1 = np.asarray(q1, dtype=np.float64).reshape(-1, 4)
+    t = np.asarray(t, dtype=np.float64).reshape(-1, 1)
+
+    dot = np.sum(q0 * q1, axis=1, keepdims=True)
+    # Take the short way round
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sinTheta = np.sin(theta)
+    # Fall back to linear interpolation when the quaternions are almost equal
+    small = sinTheta < 1e-6
+    safeSin = np.where(small, 1.0, sinTheta)
+
+    w0 = np.where(small, 1 - t, np.sin((1 - t) * theta) / safeSin)
+    w1 = np.where(small, t, np.sin(t * theta) / safeSin)
+
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+# Resample quaternions taken at increasing times onto the grid start + k / rate
+# that lies within [times[0], times[-1]]. Returns (gridTimes, quaternions).
+def resampleQuaternions(times, quats, rate, start=None):
+    times = np.asarray(times, dtype=np.float64)
+    quats = np.asarray(quats, dtype=np.float64).reshape(-1, 4)
+
+    if len(times) == 0:
+        return np.empty(0), np.empty((0, 4))
+
+    if start is None:
+        start = times[0]
+
+    first = max(0, math.ceil((times[0] - start) * rate - 1e-9))
+    last = math.floor((times[-1] - start) * rate + 1e-9)
+
+    if last < first:
+        return np.empty(0), np.empty((0, 4))
+
+    grid = start + np.arange(first, last + 1) / rate
+
+    if len(times) == 1:
+        return grid, np.repeat(quats, len(grid), axis=0)
+
+    right = np.clip(np.searchsorted(times, grid, side="right"), 1, len(times) - 1)
+    left = right - 1
+    span = times[right] - times[left]
+    t = np.where(span > 0, (grid - times[left]) / np.where(span > 0, span, 1), 0)
+
+    return grid, slerp(quats[left], quats[right], np.clip(t, 0, 1))
+
+
+# Madgwick AHRS filter fusing accelerometer, gyroscope and optionally magnetometer
+# samples into a w, x, y, z quaternion. gyro in rad/s, acc and mag in any unit.
+class MadgwickFilter:
+    def __init__(self, beta=0.1):
+        self.beta = beta
+        self.q = [1.0, 0.0, 0.0, 0.0]
+
+    def update(self, gyro, acc, mag, dt):
+        q0, q1, q2, q3 = self.q
+        gx, gy, gz = gyro
+
+        # Rate of change of quaternion from gyroscope
+        qDot1 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qDot2 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qDot3 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qDot4 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        ax, ay, az = acc
+        aNorm = math.sqrt(ax * ax + ay * ay + az * az)
+
+        if aNorm > 0:
+            ax, ay, az = ax / aNorm, ay / aNorm, az / aNorm
+            mNorm = 0.0 if mag is None else math.sqrt(mag[0] * mag[0] + mag[1] * mag[1] + mag[2] * mag[2])
+
+            if mNorm > 0:
+                mx, my, mz = mag[0] / mNorm, mag[1] / mNorm, mag[2] / mNorm
+
+                # Reference direction of earth's magnetic field
+                hx = (
+                    mx * (q0 * q0 + q1 * q1 - q2 * q2 - q3 * q3)
+                    + 2 * my * (q1 * q2 - q0 * q3)
+                    + 2 * mz * (q1 * q3 + q0 * q2)
+                )
+                hy = (
+                    2 * mx * (q1 * q2 + q0 * q3)
+                    + my * (q0 * q0 - q1 * q1 + q2 * q2 - q3 * q3)
+                    + 2 * mz * (q2 * q3 - q0 * q1)
+                )
+                bx = math.sqrt(hx * hx + hy * hy)
+                bz = (
+                    2 * mx * (q1 * q3 - q0 * q2)
+                    + 2 * my * (q2 * q3 + q0 * q1)
+                    + mz * (q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3)
+                )
+
+                # Gradient descent corrective step
+                f1 = 2 * (q1 * q3 - q0 * q2) - ax
+                f2 = 2 * (q0 * q1 + q2 * q3) - ay
+                f3 = 1 - 2 * (q1 * q1 + q2 * q2) - az
+                f4 = 2 * bx * (0.5 - q2 * q2 - q3 * q3) + 2 * bz * (q1 * q3 - q0 * q2) - mx
+                f5 = 2 * bx * (q1 * q2 - q0 * q3) + 2 * bz * (q0 * q1 + q2 * q3) - my
+                f6 = 2 * bx * (q0 * q2 + q1 * q3) + 2 * bz * (0.5 - q1 * q1 - q2 * q2) - mz
+
+                s0 = -2 * q2 * f1 + 2 * q1 * f2 - 2 * bz * q2 * f4 + (-2 * bx * q3 + 2 * bz * q1) * f5 + 2 * bx * q2 * f6
+                s1 = (
+                    2 * q3 * f1
+                    + 2 * q0 * f2
+                    - 4 * q1 * f3
+                    + 2 * bz * q3 * f4
+                    + (2 * bx * q2 + 2 * bz * q0) * f5
+                    + (2 * bx * q3 - 4 * bz * q1) * f6
+                )
+                s2 = (
+                    -2 * q0 * f1
+                    + 2 * q3 * f2
+                    - 4 * q2 * f3
+                    + (-4 * bx * q2 - 2 * bz * q0) * f4
+                    + (2 * bx * q1 + 2 * bz * q3) * f5
+                    + (2 * bx * q0 - 4 * bz * q2) * f6
+                )
+                s3 = (
+                    2 * q1 * f1
+                    + 2 * q2 * f2
+                    + (-4 * bx * q3 + 2 * bz * q1) * f4
+                    + (-2 * bx * q0 + 2 * bz * q2) * f5
+                    + 2 * bx * q1 * f6
+                )
+            else:
+                f1 = 2 * (q1 * q3 - q0 * q2) - ax
+                f2 = 2 * (q0 * q1 + q2 * q3) - ay
+                f3 = 1 - 2 * (q1 * q1 + q2 * q2) - az
+
+                s0 = -2 * q2 * f1 + 2 * q1 * f2
+                s1 = 2 * q3 * f1 + 2 * q0 * f2 - 4 * q1 * f3
+                s2 = -2 * q0 * f1 + 2 * q3 * f2 - 4 * q2 * f3
+                s3 = 2 * q1 * f1 + 2 * q2 * f2
+
+            sNorm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+
+            if sNorm > 0:
+                qDot1 -= self.beta * s0 / sNorm
+                qDot2 -= self.beta * s1 / sNorm
+                qDot3 -= self.beta * s2 / sNorm
+                qDot4 -= self.beta * s3 / sNorm
+
+        q0 += qDot1 * dt
+        q1 += qDot2 * dt
+        q2 += qDot3 * dt
+        q3 += qDot4 * dt
+
+        norm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q = [q0 / norm, q1 / norm, q2 / norm, q3 / norm]
+        return self.q
+
+
+# Orientation from the quaternion stream only, so DNF_EULERANGLE and
+# DNF_ROTATIONMATRIX can stay off and their bandwidth goes to EMG.
+#
+# Feed onData with the packets GForceProfile delivers. Quaternions are buffered
+# with their arrival time and converted in batches by the read methods.
+# With fusion=True quaternions are computed on the host from NTF_ACC_DATA,
+# NTF_GYO_DATA and, when enabled, NTF_MAG_DATA instead, so all device side
+# orientation can be switched off. A fused sample is produced per gyroscope packet.
+# vectorFormat is the struct layout of their payload, a struct.Struct or a format
+# string unpacking to x, y, z.
+#
+# Packets of a used type whose length does not match its format are counted in
+# rejectedPackets and reported once per type.
+class OrientationStream:
+    def __init__(
+        self,
+        fusion=False,
+        beta=0.1,
+        gyroRate=None,
+        accScale=DEFAULT_VECTOR_SCALE,
+        gyroScale=DEFAULT_VECTOR_SCALE,
+        magScale=DEFAULT_VECTOR_SCALE,
+        vectorFormat=VECTOR_FORMAT,
+        profile=None,
+        onData=None,
+    ):
+        self.fusion = fusion
+        self.gyroRate = gyroRate
+        self.accScale = accScale
+        self.gyroScale = gyroScale
+        self.magScale = magScale
+        self.vectorFormat = struct.Struct(vectorFormat) if isinstance(vectorFormat, str) else vectorFormat
+        self.profile = profile
+        self.nextOnData = onData
+        self.rejectedPackets = 0
+
+        self.filter = MadgwickFilter(beta) if fusion else None
+        self.acc = None
+        self.mag = None
+        self.lastGyroTime = None
+
+        self._times = []
+        self._quats = []
+        # Last sample returned by readResampled, to interpolate across reads
+        self._lastTime = None
+        self._lastQuat = None
+        self._gridStart = None
+        self._gridIndex = 0
+        self._rejectedTypes = set()
+
+    def onData(self, data):
+        if len(data) > 0:
+            if self.profile != None:
+                now = self.profile.lastNotifTime
+            else:
+                now = time.perf_counter()
+
+            if self.fusion:
+                self._fuse(data, now)
+            elif data[0] == NotifDataType.NTF_QUAT_FLOAT_DATA and self._accept(data, QUAT_FORMAT):
+                self._times.append(now)
+                self._quats.append(QUAT_FORMAT.unpack_from(bytes(data), 1))
+
+        if self.nextOnData != None:
+            self.nextOnData(data)
+
+    def _accept(self, data, fmt):
+        if len(data) == 1 + fmt.size:
+            return True
+
+        self.rejectedPackets += 1
+        if data[0] not in self._rejectedTypes:
+            self._rejectedTypes.add(data[0])
+            print(
+                "OrientationStream: dropping type {0} packets of {1} bytes, expected {2}".format(
+                    hex(data[0]), len(data), 1 + fmt.size
+                )
+            )
+        return False
+
+    def _fuse(self, data, now):
+        vectorTypes = (NotifDataType.NTF_ACC_DATA, NotifDataType.NTF_GYO_DATA, NotifDataType.NTF_MAG_DATA)
+        if data[0] not in vectorTypes or not self._accept(data, self.vectorFormat):
+            return
+
+        v = self.vectorFormat.unpack_from(bytes(data), 1)
+
+        if data[0] == NotifDataType.NTF_ACC_DATA:
+            self.acc = [i * self.accScale for i in v]
+        elif data[0] == NotifDataType.NTF_MAG_DATA:
+            self.mag = [i * self.magScale for i in v]
+        elif data[0] == NotifDataType.NTF_GYO_DATA and self.acc != None:
+            if self.gyroRate != None:
+                dt = 1.0 / self.gyroRate
+            elif self.lastGyroTime != None:
+                dt = now - self.lastGyroTime
+            else:
+                dt = 0.0
+            self.lastGyroTime = now
+
+            gyro = [math.radians(i * self.gyroScale) for i in v]
+            self._times.append(now)
+            self._quats.append(tuple(self.filter.update(gyro, self.acc, self.mag, dt)))
+
+    # Return (times, quaternions) received since the last read
+    def read(self):
+        times = np.asarray(self._times, dtype=np.float64)
+        quats = np.asarray(self._quats, dtype=np.float64).reshape(-1, 4)
+        self._times = []
+        self._quats = []
+        return times, quats
+
+    # Return (times, Euler angles) received since the last read
+    def readEuler(self):
+        times, quats = self.read()
+        return times, quatToEuler(quats)
+
+    # Return (times, rotation matrices) received since the last read
+    def readRotationMatrices(self):
+        times, quats = self.read()
+        return times, quatToRotationMatrix(quats)
+
+    # Return (gridTimes, quaternions) on a fixed rate grid for the samples received
+    # since the last read. The grid continues across reads without gaps.
+    def readResampled(self, rate):
+        times, quats = self.read()
+
+        if self._lastTime != None:
+            times = np.concatenate(([self._lastTime], times))
+            quats = np.concatenate(([self._lastQuat], quats))
+
+        if len(times) == 0:
+            return np.empty(0), np.empty((0, 4))
+
+        if self._gridStart == None:
+            self._gridStart = times[0]
+            self._gridIndex = 0
+
+        start = self._gridStart + self._gridIndex / rate
+        grid, resampled = resampleQuaternions(times, quats, rate, start)
+
+        self._gridIndex += len(grid)
+        self._lastTime = times[-1]
+        self._lastQuat = quats[-1]
+        return grid, resampled
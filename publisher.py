@@ -0,0 +1,307 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import asyncio
+import os
+import struct
+import time
+from urllib.parse import urlparse
+
+from gforce import GF_RET_CODE, NotifDataType
+
+# Wire format (all little endian)
+#
+#   message  = length(uint32) + body, length counts the body only
+#   body     = sequence(uint32) + frameCount(uint16) + frame * frameCount
+#   frame    = frameLength(uint16) + frame bytes, frame[0] is the NotifDataType
+#
+# Subscribers select the data types they want by sending
+#
+#   subscribe = typeCount(uint8) + type(uint8) * typeCount, typeCount 0 means all types
+#
+# In raw mode a fragment [NTF_PARTIAL_DATA, packet number, ...] is selected by the
+# type of the packet it belongs to, so subscribers get every fragment they need
+# to reassemble it.
+#
+# TCP and unix socket subscribers may send a new subscribe message at any time.
+# UDP subscribers register by sending a subscribe datagram and must repeat it
+# within udpTimeout seconds to stay registered.
+MSG_HEADER = struct.Struct("<IIH")
+FRAME_HEADER = struct.Struct("<H")
+
+# Keep UDP datagrams below the 64KB limit
+MAX_DATAGRAM_SIZE = 60000
+
+
+class _Subscriber:
+    def __init__(self, writer=None, addr=None):
+        self._writer = writer
+        self._addr = addr
+        self._types = None
+        self._lastSeen = time.monotonic()
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, publisher):
+        self._publisher = publisher
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self._publisher._onUdpSubscribe(self, data, addr)
+
+
+# Serves the notification stream of one GForceProfile to many local subscribers.
+#
+# With raw=False every reassembled packet (what onData receives) is one frame,
+# with raw=True every BLE notification is forwarded before reassembly.
+# Frames are batched until batchPackets frames or batchTime milliseconds have
+# been collected. A TCP or unix socket subscriber whose unsent data exceeds
+# maxBufferSize bytes is disconnected so it never stalls the device.
+class GForcePublisher:
+    def __init__(self, profile, raw=False, batchPackets=32, batchTime=10, maxBufferSize=1 << 20, udpTimeout=5.0):
+        self.profile = profile
+        self.raw = raw
+        self.batchPackets = batchPackets
+        self.batchTime = batchTime
+        self.maxBufferSize = maxBufferSize
+        self.udpTimeout = udpTimeout
+        self.onData = None
+
+        self.servers = []
+        self.udpEndpoints = []
+        self.subscribers = []
+        self.udpSubscribers = {}
+        self.sequence = 0
+        self.droppedSubscribers = 0
+
+        self._frames = []
+        # NotifDataType each frame is filtered by
+        self._frameTypes = []
+        self._frameBytes = 0
+        # Type and packet number of the fragmented packet in progress, raw mode only
+        self._partialType = None
+        self._partialId = 0
+        self._flushHandle = None
+        self._loop = None
+
+    # Start listening, url is one of tcp://host:port, udp://host:port or unix:///path
+    async def serve(self, url):
+        self._loop = asyncio.get_running_loop()
+        u = urlparse(url)
+
+        if u.scheme == "tcp":
+            server = await asyncio.start_server(self._onStreamClient, u.hostname, u.port)
+            self.servers.append(server)
+        elif u.scheme == "unix":
+            if os.path.exists(u.path):
+                os.unlink(u.path)
+            server = await asyncio.start_unix_server(self._onStreamClient, u.path)
+            self.servers.append(server)
+        elif u.scheme == "udp":
+            _, protocol = await self._loop.create_datagram_endpoint(
+                lambda: _UdpProtocol(self), local_addr=(u.hostname, u.port)
+            )
+            self.udpEndpoints.append(protocol)
+        else:
+            return GF_RET_CODE.GF_ERROR_BAD_PARAM
+
+        print("Publishing on {0}".format(url))
+        return GF_RET_CODE.GF_SUCCESS
+
+    # Start the data notification of the profile and publish everything it delivers.
+    # onData, if given, still receives every reassembled packet.
+    async def startDataNotification(self, onData=None):
+        self._loop = asyncio.get_running_loop()
+        self.onData = onData
+
+        if self.raw:
+            self.profile.onRawData = self.publish
+            return await self.profile.startDataNotification(self._passThrough)
+        else:
+            return await self.profile.startDataNotification(self._onPacket)
+
+    async def stopDataNotification(self):
+        ret = await self.profile.stopDataNotification()
+        if self.raw:
+            self.profile.onRawData = None
+        self.flush()
+        return ret
+
+    async def close(self):
+        self.flush()
+
+        for server in self.servers:
+            server.close()
+
+        for protocol in self.udpEndpoints:
+            protocol.transport.close()
+        self.udpEndpoints = []
+
+        subscribers = self.subscribers
+        self.subscribers = []
+        self.udpSubscribers = {}
+
+        for sub in subscribers:
+            sub._writer.close()
+        for sub in subscribers:
+            try:
+                await sub._writer.wait_closed()
+            except ConnectionError:
+                pass
+
+        # Since Python 3.12.1 this waits for every client connection to be closed
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    def _passThrough(self, data):
+        if self.onData != None:
+            self.onData(data)
+
+    def _onPacket(self, data):
+        self.publish(data)
+        self._passThrough(data)
+
+    # Queue one frame, must be called from the event loop thread
+    def publish(self, data):
+        if len(data) == 0:
+            return
+
+        self._frames.append(bytes(data))
+        self._frameTypes.append(self._frameType(data))
+        self._frameBytes += FRAME_HEADER.size + len(data)
+
+        if len(self._frames) >= self.batchPackets or self._frameBytes >= MAX_DATAGRAM_SIZE:
+            self.flush()
+        elif self._flushHandle == None:
+            self._flushHandle = self._loop.call_later(self.batchTime / 1000, self.flush)
+
+    # Send the pending frames to all subscribers
+    def flush(self):
+        if self._flushHandle != None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+
+        if len(self._frames) == 0:
+            return
+
+        frames = self._frames
+        frameTypes = self._frameTypes
+        self._frames = []
+        self._frameTypes = []
+        self._frameBytes = 0
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+        # Subscribers with the same filter share one encoded message
+        messages = {}
+
+        for sub in list(self.subscribers):
+            transport = sub._writer.transport
+            if transport.is_closing():
+                self._removeSubscriber(sub)
+                continue
+
+            if transport.get_write_buffer_size() > self.maxBufferSize:
+                print("Dropping slow subscriber {0}".format(sub._writer.get_extra_info("peername")))
+                self.droppedSubscribers += 1
+                self._removeSubscriber(sub)
+                continue
+
+            msg = self._encode(frames, frameTypes, sub._types, messages)
+            if msg != None:
+                sub._writer.write(msg)
+
+        if len(self.udpSubscribers) > 0:
+            now = time.monotonic()
+
+            for key, sub in list(self.udpSubscribers.items()):
+                protocol, addr = key
+                if now - sub._lastSeen > self.udpTimeout or protocol.transport.is_closing():
+                    del self.udpSubscribers[key]
+                    continue
+
+                msg = self._encode(frames, frameTypes, sub._types, messages)
+                if msg != None:
+                    # Datagrams are dropped by the OS instead of blocking
+                    protocol.transport.sendto(msg, addr)
+
+    def _frameType(self, data):
+        if not self.raw or data[0] != NotifDataType.NTF_PARTIAL_DATA or len(data) < 3:
+            return data[0]
+
+        # Packet numbers count down to 0, a number that does not continue the
+        # sequence starts a new packet whose content begins with its type
+        if self._partialType == None or data[1] >= self._partialId:
+            self._partialType = data[2]
+        self._partialId = data[1]
+
+        frameType = self._partialType
+        if data[1] == 0:
+            self._partialType = None
+        return frameType
+
+    def _encode(self, frames, frameTypes, types, cache):
+        if types in cache:
+            return cache[types]
+
+        selected = frames if types == None else [f for f, t in zip(frames, frameTypes) if t in types]
+
+        if len(selected) == 0:
+            msg = None
+        else:
+            parts = []
+            for f in selected:
+                parts.append(FRAME_HEADER.pack(len(f)))
+                parts.append(f)
+            body = b"".join(parts)
+            msg = MSG_HEADER.pack(MSG_HEADER.size - 4 + len(body), self.sequence, len(selected)) + body
+
+        cache[types] = msg
+        return msg
+
+    def _removeSubscriber(self, sub):
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+        sub._writer.close()
+
+    @staticmethod
+    def _parseSubscribe(data):
+        if len(data) < 1 or len(data) < 1 + data[0]:
+            return False, None
+
+        if data[0] == 0:
+            return True, None
+
+        return True, frozenset(data[1 : 1 + data[0]])
+
+    async def _onStreamClient(self, reader, writer):
+        sub = _Subscriber(writer=writer)
+        self.subscribers.append(sub)
+
+        try:
+            while True:
+                count = await reader.readexactly(1)
+                types = await reader.readexactly(count[0])
+                _, sub._types = self._parseSubscribe(count + types)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._removeSubscriber(sub)
+
+    def _onUdpSubscribe(self, protocol, data, addr):
+        ok, types = self._parseSubscribe(data)
+        if not ok:
+            return
+
+        key = (protocol, addr)
+        sub = self.udpSubscribers.get(key)
+
+        if sub == None:
+            sub = _Subscriber(addr=addr)
+            self.udpSubscribers[key] = sub
+
+        sub._types = types
+        sub._lastSeen = time.monotonic()
@@ -0,0 +1,169 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import math
+
+import numpy as np
+
+from emg import decodeEmgPacket, emgFullScale
+from gforce import NotifDataType
+
+
+class EmgQuality(int):
+    EMG_QUALITY_GOOD = 0
+    EMG_QUALITY_FAIR = 1
+    EMG_QUALITY_BAD = 2
+    # No signal at all, usually a loose electrode
+    EMG_QUALITY_FLAT = 3
+
+
+# Per channel metrics of one evaluation period
+class EmgQualityReport:
+    def __init__(self, std, clipRate, mainsRatio, maxCorrelation, score, quality):
+        # Standard deviation in ADC codes
+        self.std = std
+        # Fraction of samples at 0 or full scale
+        self.clipRate = clipRate
+        # Share of the signal power at the mains frequency
+        self.mainsRatio = mainsRatio
+        # Highest correlation with any other channel
+        self.maxCorrelation = maxCorrelation
+        # 0 (unusable) to 1 (clean)
+        self.score = score
+        self.quality = quality
+
+
+# Monitor the EMG signal quality of one device, channel by channel.
+#
+# Feed onData with the packets GForceProfile delivers, or update() with decoded
+# (samples, channels) blocks. A packet only costs a copy into a preallocated
+# period buffer; every period seconds the buffer is evaluated in three matrix
+# products into a report per channel:
+#
+#   flatline:    standard deviation below flatStd codes
+#   clipping:    fraction of samples at 0 or full scale of the resolution
+#   mains noise: power at mainsFreq relative to the total signal power
+#   correlation: highest correlation with another channel, bridged or shorted
+#                electrodes read nearly the same signal
+#
+# Each metric maps to a 0..1 penalty against its limit and the score is their
+# product. onQualityChanged(device, channel, old, new, report) is called when a
+# channel's EmgQuality changes. self.reports holds the latest reports.
+class EmgQualityMonitor:
+    def __init__(
+        self,
+        channels,
+        resolution,
+        sampRate,
+        device=None,
+        mainsFreq=50,
+        period=0.5,
+        flatStd=1.0,
+        clipLimit=0.05,
+        mainsLimit=0.5,
+        correlationLimit=0.95,
+        onQualityChanged=None,
+        onData=None,
+    ):
+        self.channels = channels
+        self.resolution = resolution
+        self.sampRate = sampRate
+        self.device = device
+        self.mainsFreq = mainsFreq
+        self.flatStd = flatStd
+        self.clipLimit = clipLimit
+        self.mainsLimit = mainsLimit
+        self.correlationLimit = correlationLimit
+        self.onQualityChanged = onQualityChanged
+        self.nextOnData = onData
+
+        self.periodSamples = max(2, int(period * sampRate))
+        self.fullScale = emgFullScale(resolution)
+        self.quality = [None] * channels
+        self.reports = [None] * channels
+
+        self._block = np.empty((self.periodSamples, channels))
+        self._n = 0
+        # Rows give the sum and the mains I/Q of every channel in one product. The
+        # mains power does not depend on the phase, so one basis serves every period.
+        phase = 2 * np.pi * mainsFreq / sampRate * np.arange(self.periodSamples)
+        self._basis = np.vstack((np.ones(self.periodSamples), np.cos(phase), np.sin(phase)))
+        self._basisSums = self._basis.sum(axis=1)
+
+    def onData(self, data):
+        if len(data) > 0 and data[0] == NotifDataType.NTF_EMG_ADC_DATA:
+            self.update(decodeEmgPacket(data, self.channels, self.resolution))
+
+        if self.nextOnData != None:
+            self.nextOnData(data)
+
+    def update(self, samples):
+        n = len(samples)
+        pos = 0
+
+        while pos < n:
+            k = min(n - pos, self.periodSamples - self._n)
+            self._block[self._n : self._n + k] = samples[pos : pos + k]
+            self._n += k
+            pos += k
+
+            if self._n == self.periodSamples:
+                self._evaluate()
+                self._n = 0
+
+    def _evaluate(self):
+        x = self._block
+        n = len(x)
+
+        # The only passes over the samples; everything after works on per channel
+        # values in plain Python, where a few dozen numbers cost less than numpy calls
+        clipped = (self._basis[0] @ ((x == 0) | (x == self.fullScale))).tolist()
+        total, i, q = (self._basis @ x).tolist()
+        cross = (x.T @ x).tolist()
+        cosSum, sinSum = self._basisSums[1:].tolist()
+
+        channels = range(self.channels)
+        mean = [total[ch] / n for ch in channels]
+        var = [max(cross[ch][ch] / n - mean[ch] * mean[ch], 0.0) for ch in channels]
+        std = [math.sqrt(v) for v in var]
+
+        for ch in channels:
+            clipRate = clipped[ch] / n
+
+            # Remove the DC part leaking into the mains bins, then amplitude^2 / 2
+            mi = i[ch] - mean[ch] * cosSum
+            mq = q[ch] - mean[ch] * sinSum
+            mainsPower = 2 * (mi * mi + mq * mq) / (n * n)
+            mainsRatio = min(max(mainsPower / var[ch], 0.0), 1.0) if var[ch] > 0 else 0.0
+
+            maxCorr = 0.0
+            for other in channels:
+                if other != ch and std[ch] > 0 and std[other] > 0:
+                    cov = cross[ch][other] / n - mean[ch] * mean[other]
+                    maxCorr = max(maxCorr, abs(cov / (std[ch] * std[other])))
+
+            if std[ch] < self.flatStd:
+                score = 0.0
+                quality = EmgQuality.EMG_QUALITY_FLAT
+            else:
+                score = (
+                    (1 - min(1, clipRate / self.clipLimit))
+                    * (1 - min(1, mainsRatio / self.mainsLimit))
+                    * (1 - min(max((maxCorr - self.correlationLimit) / (1 - self.correlationLimit), 0), 1))
+                )
+
+                if score >= 0.7:
+                    quality = EmgQuality.EMG_QUALITY_GOOD
+                elif score >= 0.3:
+                    quality = EmgQuality.EMG_QUALITY_FAIR
+                else:
+                    quality = EmgQuality.EMG_QUALITY_BAD
+
+            report = EmgQualityReport(std[ch], clipRate, mainsRatio, maxCorr, score, quality)
+            self.reports[ch] = report
+
+            old = self.quality[ch]
+            self.quality[ch] = quality
+
+            if old != quality and self.onQualityChanged != None:
+                self.onQualityChanged(self.device, ch, old, quality, report)
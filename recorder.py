@@ -0,0 +1,252 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Headless recorder: scan, connect, configure and record or stream until a signal arrives.
+# If any device disconnects the recorder stops and exits with status 1, so a
+# supervisor can restart it.
+#
+#   python3 recorder.py --name-prefix gForce --notify emg_raw --output session.gfr
+#   python3 recorder.py --address 00:11:22:33:44:55 --notify quaternion --serve tcp://0.0.0.0:9000
+#
+# Only argparse and the protocol definitions are imported up front; bleak is
+# loaded on connect and the publisher only with --serve, so --help and restarts
+# by a supervisor stay fast.
+
+import argparse
+import asyncio
+import signal
+import struct
+import sys
+import time
+
+from gforce import DataNotifFlags, GForceProfile, ResponseResult
+
+# Recording file: MAGIC, then one record per packet
+#   record = time(float64, seconds since epoch) + device(uint8) + length(uint16) + packet
+RECORD_MAGIC = b"GFREC\x01"
+RECORD_HEADER = struct.Struct("<dBH")
+
+
+def parseNotifFlags(text):
+    flags = DataNotifFlags.DNF_OFF
+
+    for name in text.split(","):
+        name = name.strip()
+        if name == "":
+            continue
+
+        try:
+            flags |= int(name, 0)
+        except ValueError:
+            attr = "DNF_" + name.upper()
+            if not hasattr(DataNotifFlags, attr):
+                raise argparse.ArgumentTypeError("unknown notification: {0}".format(name))
+            flags |= getattr(DataNotifFlags, attr)
+
+    return flags
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description="Record or stream gForce data without user interaction.")
+
+    dev = parser.add_argument_group("devices")
+    dev.add_argument("--address", action="append", default=[], help="device address to connect, repeatable")
+    dev.add_argument("--name-prefix", action="append", default=[], help="connect devices whose name starts with this, repeatable")
+    dev.add_argument("--max-devices", type=int, default=1, help="devices to connect per name prefix (default: 1)")
+    dev.add_argument("--scan-time", type=float, default=5, help="scan duration in seconds (default: 5)")
+    dev.add_argument("--min-rssi", type=int, default=-128, help="ignore devices below this RSSI")
+
+    cfg = parser.add_argument_group("configuration")
+    cfg.add_argument(
+        "--notify",
+        type=parseNotifFlags,
+        default=DataNotifFlags.DNF_EMG_RAW,
+        help="comma separated DataNotifFlags without DNF_, or a number (default: emg_raw)",
+    )
+    cfg.add_argument("--emg-rate", type=int, default=500, help="EMG sample rate (default: 500)")
+    cfg.add_argument("--emg-channels", type=lambda s: int(s, 0), default=0xFF, help="EMG channel mask (default: 0xFF)")
+    cfg.add_argument("--emg-len", type=int, default=128, help="EMG packet data length (default: 128)")
+    cfg.add_argument("--emg-resolution", type=int, choices=(8, 12), default=8, help="EMG resolution (default: 8)")
+    cfg.add_argument("--timeout", type=int, default=1000, help="command timeout in milliseconds (default: 1000)")
+
+    out = parser.add_argument_group("output")
+    out.add_argument("--output", help="record file, {index} is replaced by the device index")
+    out.add_argument(
+        "--serve",
+        action="append",
+        default=[],
+        help="publish on tcp://host:port, udp://host:port or unix:///path, {index} is replaced by the device index",
+    )
+    out.add_argument("--raw", action="store_true", help="publish BLE notifications before reassembly")
+    out.add_argument("--duration", type=float, help="stop after this many seconds")
+
+    return parser
+
+
+class _Device:
+    def __init__(self, index, address):
+        self.index = index
+        self.address = address
+        self.profile = GForceProfile()
+        self.publishers = []
+        self.file = None
+        self.packets = 0
+        self.dropped = False
+
+
+async def _findAddresses(args):
+    addresses = list(args.address)
+
+    if len(args.name_prefix) > 0:
+        scanner = GForceProfile()
+
+        for prefix in args.name_prefix:
+            found = await scanner.scan(args.scan_time, prefix, args.min_rssi)
+            found = sorted(found, key=lambda d: d["rssi"], reverse=True)
+            addresses += [d["address"] for d in found[: args.max_devices] if d["address"] not in addresses]
+
+    return addresses
+
+
+async def _start(dev, args, write):
+    p = dev.profile
+    await p.connect(dev.address)
+
+    if args.notify & DataNotifFlags.DNF_EMG_RAW:
+        resp = (
+            await p.request(
+                p.setEmgRawDataConfig,
+                args.emg_rate,
+                args.emg_channels,
+                args.emg_len,
+                args.emg_resolution,
+                timeout=args.timeout,
+            )
+        )[0]
+        if resp != ResponseResult.RSP_CODE_SUCCESS:
+            print("[{0}] setEmgRawDataConfig failed: {1}".format(dev.index, resp))
+
+    resp = (await p.request(p.setDataNotifSwitch, args.notify, timeout=args.timeout))[0]
+    if resp != ResponseResult.RSP_CODE_SUCCESS:
+        print("[{0}] setDataNotifSwitch failed: {1}".format(dev.index, resp))
+
+    def onData(data):
+        dev.packets += 1
+        if write:
+            write(dev, data)
+
+    if len(args.serve) > 0:
+        from publisher import GForcePublisher
+
+        pub = GForcePublisher(p, raw=args.raw)
+        for url in args.serve:
+            await pub.serve(url.format(index=dev.index))
+        dev.publishers.append(pub)
+        return await pub.startDataNotification(onData)
+
+    return await p.startDataNotification(onData)
+
+
+async def _stop(dev, args):
+    p = dev.profile
+
+    # Nothing can be sent to a device that is gone
+    if dev.dropped:
+        for pub in dev.publishers:
+            await pub.close()
+        return
+
+    try:
+        if len(dev.publishers) > 0:
+            for pub in dev.publishers:
+                await pub.stopDataNotification()
+                await pub.close()
+        else:
+            await p.stopDataNotification()
+        await p.request(p.setDataNotifSwitch, DataNotifFlags.DNF_OFF, timeout=args.timeout)
+    finally:
+        await p.disconnect()
+
+
+async def run(args):
+    addresses = await _findAddresses(args)
+    if len(addresses) == 0:
+        print("No device found")
+        return 1
+
+    devices = [_Device(i, addr) for i, addr in enumerate(addresses)]
+    files = {}
+    write = None
+
+    if args.output:
+        for dev in devices:
+            path = args.output.format(index=dev.index)
+            if path not in files:
+                files[path] = open(path, "wb")
+                files[path].write(RECORD_MAGIC)
+            dev.file = files[path]
+
+        def write(dev, data):
+            dev.file.write(RECORD_HEADER.pack(time.time(), dev.index, len(data)))
+            dev.file.write(bytes(data))
+
+    stopEvent = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopEvent.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops have no signal handlers
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stopEvent.set))
+
+    # Disconnects after stopEvent was set are our own
+    def onDrop(dev):
+        if not stopEvent.is_set():
+            print("[{0}] {1} disconnected".format(dev.index, dev.address))
+            dev.dropped = True
+            stopEvent.set()
+
+    for dev in devices:
+        dev.profile.onDisconnect = lambda _, dev=dev: loop.call_soon_threadsafe(onDrop, dev)
+
+    started = []
+    try:
+        for dev in devices:
+            started.append(dev)
+            ret = await _start(dev, args, write)
+            print("[{0}] {1} streaming: {2}".format(dev.index, dev.address, ret))
+
+        try:
+            await asyncio.wait_for(stopEvent.wait(), args.duration)
+        except asyncio.TimeoutError:
+            pass
+
+        print("Stopping...")
+    finally:
+        stopEvent.set()
+        for dev in started:
+            try:
+                await _stop(dev, args)
+            except Exception as e:
+                print("[{0}] stop failed: {1}".format(dev.index, e))
+            print("[{0}] {1} packets".format(dev.index, dev.packets))
+
+        for f in files.values():
+            f.close()
+
+    return 1 if any(dev.dropped for dev in devices) else 0
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+
+    if len(args.address) == 0 and len(args.name_prefix) == 0:
+        print("Give at least one --address or --name-prefix")
+        return 2
+
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import asyncio
+
+from gforce import DataNotifFlags, EmgRawDataConfig, ResponseResult
+
+
+# Everything a session configures on the device. Unset (None) parts are left alone.
+#
+#   emgRawDataConfig:     EmgRawDataConfig
+#   accelerateConfig:     (sampRate, fullScale, dataLen), fullScale in g
+#   gyroscopeConfig:      (sampRate, fullScale, dataLen), fullScale in dps
+#   magnetometerConfig:   (sampRate, fullScale, dataLen), fullScale in uT
+#   eulerAngleConfig:     sampRate
+#   quaternionConfig:     sampRate
+#   rotationMatrixConfig: sampRate
+#   packageId:            True to prefix data notifications with a packet id. The
+#                         decoders of this package (emg, orientation, alignment,
+#                         windowing, quality) expect packets without it, so leave
+#                         it off when using them
+#   notifFlags:           DataNotifFlags
+class SessionProfile:
+    def __init__(
+        self,
+        notifFlags=None,
+        emgRawDataConfig=None,
+        accelerateConfig=None,
+        gyroscopeConfig=None,
+        magnetometerConfig=None,
+        eulerAngleConfig=None,
+        quaternionConfig=None,
+        rotationMatrixConfig=None,
+        packageId=None,
+    ):
+        self.notifFlags = notifFlags
+        self.emgRawDataConfig = emgRawDataConfig
+        self.accelerateConfig = accelerateConfig
+        self.gyroscopeConfig = gyroscopeConfig
+        self.magnetometerConfig = magnetometerConfig
+        self.eulerAngleConfig = eulerAngleConfig
+        self.quaternionConfig = quaternionConfig
+        self.rotationMatrixConfig = rotationMatrixConfig
+        self.packageId = packageId
+
+    def __repr__(self):
+        parts = ["{0}={1}".format(name, value) for name, value in self.items()]
+        return "SessionProfile({0})".format(", ".join(parts))
+
+    # (name, value) of every set part, in the order they are sent
+    def items(self):
+        return [(name, getattr(self, name)) for name in SESSION_COMMANDS if getattr(self, name) != None]
+
+    # Copy of this profile with the parts of other set on top
+    def merge(self, other):
+        merged = SessionProfile()
+        for name in SESSION_COMMANDS:
+            setattr(merged, name, getattr(self, name))
+        for name, value in other.items():
+            setattr(merged, name, value)
+        return merged
+
+    # List of problems, empty when the profile can be sent
+    def validate(self):
+        errors = []
+
+        c = self.emgRawDataConfig
+        if c != None:
+            if not isinstance(c, EmgRawDataConfig):
+                errors.append("emgRawDataConfig: not an EmgRawDataConfig")
+            else:
+                errors += ["emgRawDataConfig: " + e for e in c.validate()]
+
+        imuConfigs = (("accelerateConfig", 0xFF), ("gyroscopeConfig", 0xFFFF), ("magnetometerConfig", 0xFFFF))
+        for name, fullScaleMax in imuConfigs:
+            value = getattr(self, name)
+            if value == None:
+                continue
+            if len(value) != 3:
+                errors.append("{0}: expected (sampRate, fullScale, dataLen)".format(name))
+                continue
+
+            sampRate, fullScale, dataLen = value
+            if not 0 < sampRate <= 0xFFFF:
+                errors.append("{0}: sampRate {1} out of range".format(name, sampRate))
+            if not 0 < fullScale <= fullScaleMax:
+                errors.append("{0}: fullScale {1} out of range".format(name, fullScale))
+            if not 0 < dataLen <= 0xFF:
+                errors.append("{0}: dataLen {1} out of range".format(name, dataLen))
+
+        for name in ("eulerAngleConfig", "quaternionConfig", "rotationMatrixConfig"):
+            value = getattr(self, name)
+            if value != None and not 0 < value <= 0xFFFF:
+                errors.append("{0}: sampRate {1} out of range".format(name, value))
+
+        if self.notifFlags != None and not 0 <= self.notifFlags <= DataNotifFlags.DNF_ALL:
+            errors.append("notifFlags: {0} out of range".format(self.notifFlags))
+
+        return errors
+
+
+# Part of a SessionProfile -> (GForceProfile setter, setter arguments of the value).
+# The notification switch is last so the device only starts streaming once it has
+# seen the new configs.
+SESSION_COMMANDS = {
+    "emgRawDataConfig": ("setEmgRawDataConfig", EmgRawDataConfig.astuple),
+    "accelerateConfig": ("setAccelerateConfig", tuple),
+    "gyroscopeConfig": ("setGyroscopeConfig", tuple),
+    "magnetometerConfig": ("setMagnetometerConfig", tuple),
+    "eulerAngleConfig": ("setEulerAngleConfig", lambda v: (v,)),
+    "quaternionConfig": ("setQuaternionConfig", lambda v: (v,)),
+    "rotationMatrixConfig": ("setRotationMatrixConfig", lambda v: (v,)),
+    "packageId": ("setPackageIdControl", lambda v: (v,)),
+    "notifFlags": ("setDataNotifSwitch", lambda v: (v,)),
+}
+
+
+class SessionResult:
+    def __init__(self):
+        # Part name -> ResponseResult, or the GF_RET_CODE of a command that could not be
+        # sent; RSP_CODE_FAILED when its write raised
+        self.results = {}
+        # Validation problems, nothing was sent when not empty
+        self.errors = []
+        # Part name -> ResponseResult of the commands restoring the previous config
+        self.rollback = {}
+        self.rolledBack = False
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0 and all(r == ResponseResult.RSP_CODE_SUCCESS for r in self.results.values())
+
+    def failed(self):
+        return [name for name, r in self.results.items() if r != ResponseResult.RSP_CODE_SUCCESS]
+
+    def __repr__(self):
+        return "SessionResult(ok={0}, results={1}, errors={2}, rolledBack={3})".format(
+            self.ok, self.results, self.errors, self.rolledBack
+        )
+
+
+# Send every part of values at once and wait for all the responses
+async def _sendAll(profile, values, timeout):
+    def send(name, value):
+        setter, toArgs = SESSION_COMMANDS[name]
+        return profile.request(getattr(profile, setter), *toArgs(value), timeout=timeout)
+
+    # Commands differ in type, so all of them can wait for a response at the same time.
+    # A part whose write raised counts as failed so the others still get rolled back.
+    responses = await asyncio.gather(*[send(name, value) for name, value in values], return_exceptions=True)
+
+    results = {}
+    for (name, value), resp in zip(values, responses):
+        if isinstance(resp, Exception):
+            print("applySessionProfile: send {0} failed: {1!r}".format(name, resp))
+            results[name] = ResponseResult.RSP_CODE_FAILED
+        else:
+            results[name] = resp[0]
+    return results
+
+
+# Apply a SessionProfile to a connected GForceProfile in one round trip.
+#
+# The session profile is validated first and nothing is sent if it has errors.
+# All commands are then written back to back and their responses awaited
+# together. If any command fails, the parts that did succeed are restored to the
+# previous known config: profile.sessionProfile, or the EMG config and
+# notification flags the device last accepted. Notifications that were switched
+# on without a known previous state are switched off. On success
+# profile.sessionProfile is updated with the applied parts.
+async def applySessionProfile(profile, session, timeout=1000, rollback=True):
+    result = SessionResult()
+    result.errors = session.validate()
+    if len(result.errors) > 0:
+        return result
+
+    # The setters keep these two up to date, so they win over the last session profile
+    previous = SessionProfile(notifFlags=profile.dataNotifFlags, emgRawDataConfig=profile.emgRawDataConfig)
+    if profile.sessionProfile != None:
+        previous = profile.sessionProfile.merge(previous)
+
+    values = session.items()
+    result.results = await _sendAll(profile, values, timeout)
+
+    if result.ok:
+        profile.sessionProfile = previous.merge(session)
+        return result
+
+    if not rollback:
+        return result
+
+    restore = []
+    for name, value in values:
+        if result.results[name] != ResponseResult.RSP_CODE_SUCCESS:
+            continue
+
+        old = getattr(previous, name)
+        if old == None and name == "notifFlags":
+            old = DataNotifFlags.DNF_OFF
+        if old != None and old != value:
+            restore.append((name, old))
+
+    if len(restore) > 0:
+        result.rollback = await _sendAll(profile, restore, timeout)
+        result.rolledBack = all(r == ResponseResult.RSP_CODE_SUCCESS for r in result.rollback.values())
+        if not result.rolledBack:
+            print("applySessionProfile: rollback failed: {0}".format(result.rollback))
+    else:
+        result.rolledBack = True
+
+    return result
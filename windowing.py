@@ -0,0 +1,177 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from emg import decodeEmgPacket, emgMidScale
+from gforce import NotifDataType
+
+
+# Produce fixed (window, channels) EMG tensors at a fixed stride without copying.
+#
+# Samples are written twice into a mirrored ring of 2 * capacity rows, so every
+# span of up to capacity samples is contiguous in memory. windows() returns all
+# windows completed since the last call as one read-only strided view of shape
+# (windows, window, channels) over that ring; steady state allocates nothing but
+# the view object per call. The view stays valid until capacity minus its span
+# more samples have been fed, so consume or copy it before feeding much more.
+# If windows pile up past capacity the oldest are skipped and counted in overruns.
+# Packets fed to onData are decoded with resolution, which must then be given;
+# without it only write() can be used.
+class EmgWindowProducer:
+    def __init__(
+        self, channels, window, stride, resolution=None, capacity=None, dtype=np.float32, onData=None
+    ):
+        self.channels = channels
+        self.window = window
+        self.stride = stride
+        self.resolution = resolution
+        self.capacity = capacity if capacity != None else 4 * window + 4 * stride
+        self.nextOnData = onData
+        self.overruns = 0
+
+        self._buf = np.zeros((2 * self.capacity, channels), dtype=dtype)
+        # Subtract the mid-scale offset when the resolution is known
+        self._offset = emgMidScale(resolution) if resolution != None else 0
+        # Absolute index of the next sample to write and of the next window start
+        self._count = 0
+        self._next = 0
+
+    def reset(self):
+        self._count = 0
+        self._next = 0
+
+    def onData(self, data):
+        if len(data) > 0 and data[0] == NotifDataType.NTF_EMG_ADC_DATA:
+            if self.resolution == None:
+                raise ValueError("EmgWindowProducer needs a resolution to decode packets")
+            self.write(decodeEmgPacket(data, self.channels, self.resolution))
+
+        if self.nextOnData != None:
+            self.nextOnData(data)
+
+    # Append (samples, channels) ADC codes
+    def write(self, samples):
+        n = len(samples)
+        cap = self.capacity
+
+        if n > cap:
+            self.write(samples[: n - cap])
+            samples = samples[n - cap :]
+            n = cap
+
+        pos = self._count % cap
+        first = min(n, cap - pos)
+
+        dtype = self._buf.dtype
+
+        for dst in (pos, pos + cap):
+            np.subtract(samples[:first], self._offset, out=self._buf[dst : dst + first], dtype=dtype, casting="unsafe")
+
+        if first < n:
+            rest = n - first
+            for dst in (0, cap):
+                np.subtract(
+                    samples[first:], self._offset, out=self._buf[dst : dst + rest], dtype=dtype, casting="unsafe"
+                )
+
+        self._count += n
+
+    def pending(self):
+        available = self._count - self._next
+        if available < self.window:
+            return 0
+        return (available - self.window) // self.stride + 1
+
+    # Return the pending windows as a (windows, window, channels) view and consume them.
+    # With limit, only the oldest limit windows are returned and the rest stay pending.
+    def windows(self, limit=None):
+        # Windows whose start fell out of the ring are lost
+        oldest = self._count - self.capacity
+
+        if self._next < oldest:
+            skip = -(-(oldest - self._next) // self.stride)
+            self._next += skip * self.stride
+            self.overruns += skip
+
+        count = self.pending()
+        if limit != None:
+            count = min(count, limit)
+
+        start = self._next % self.capacity
+        rowStride, colStride = self._buf.strides
+        view = as_strided(
+            self._buf[start:],
+            shape=(count, self.window, self.channels),
+            strides=(self.stride * rowStride, rowStride, colStride),
+            writeable=False,
+        )
+
+        self._next += count * self.stride
+        return view
+
+    # The most recent complete window, (window, channels), without consuming anything
+    def latest(self):
+        if self._count < self.window:
+            return None
+
+        start = (self._count - self.window) % self.capacity
+        return self._buf[start : start + self.window]
+
+
+# Batch the windows of several devices for one model call.
+#
+# windows() copies the pending windows of every device into one preallocated
+# (maxBatch, window, channels) array and returns (batch, devices) views, where
+# devices[i] is the device index of batch[i]. latest() stacks the most recent
+# window of every device into a preallocated (devices, window, channels) array.
+class EmgWindowBatcher:
+    def __init__(self, devices, channels, window, stride, resolution=None, maxBatch=64, dtype=np.float32):
+        self.producers = [
+            EmgWindowProducer(channels, window, stride, resolution, dtype=dtype) for _ in range(devices)
+        ]
+        self.maxBatch = maxBatch
+
+        self._batch = np.zeros((maxBatch, window, channels), dtype=dtype)
+        self._devices = np.zeros(maxBatch, dtype=np.int32)
+        self._latest = np.zeros((devices, window, channels), dtype=dtype)
+        self._first = 0
+
+    # Return an onData callback for device, optionally chained to onData
+    def makeOnData(self, device, onData=None):
+        producer = self.producers[device]
+        if producer.resolution == None:
+            raise ValueError("EmgWindowBatcher needs a resolution to decode packets")
+        producer.nextOnData = onData
+        return producer.onData
+
+    def windows(self):
+        n = 0
+        devices = len(self.producers)
+
+        for i in range(devices):
+            # Start with a different device every call so none is starved when the batch is full
+            device = (self._first + i) % devices
+            producer = self.producers[device]
+
+            # Windows that do not fit stay pending for the next call
+            view = producer.windows(self.maxBatch - n)
+            k = len(view)
+
+            self._batch[n : n + k] = view
+            self._devices[n : n + k] = device
+            n += k
+
+        self._first = (self._first + 1) % devices
+        return self._batch[:n], self._devices[:n]
+
+    # Returns None until every device has a full window
+    def latest(self):
+        for device, producer in enumerate(self.producers):
+            window = producer.latest()
+            if window is None:
+                return None
+            self._latest[device] = window
+
+        return self._latest